@@ -0,0 +1,47 @@
+'''Compare the time to find the number of frames in a video:
+   binary_search_end (reopening the file for each of ~24 seeks)
+   vs. count_frames (container metadata confirmed with one seek)
+
+Usage: python benchmark_frame_count.py [video_file ...]
+With no arguments, this generates some test videos in a temp directory'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from wxPyGameVideoPlayer import cv2_utils
+
+def time_call(func, *args):
+    t = time.time()
+    result = func(*args)
+    return result, time.time() - t
+
+def benchmark(video_file):
+    old, old_time = time_call(cv2_utils.binary_search_end, video_file)
+    new, new_time = time_call(cv2_utils.count_frames, video_file)
+    print('{}: binary_search_end {} frames in {:.3f}s, '
+          'count_frames {} frames in {:.3f}s ({:.1f}x)'.format(
+              os.path.basename(video_file), int(old) + 1, old_time,
+              new, new_time, old_time / max(new_time, 1e-9)))
+
+if __name__ == '__main__':
+    video_files = sys.argv[1:]
+    temp_dir = None
+    if not video_files:
+        temp_dir = tempfile.mkdtemp()
+        video_files = [cv2_utils.write_test_video(os.path.join(temp_dir, name),
+                                                  num_frames=num_frames,
+                                                  fourcc=fourcc)
+                       for name, num_frames, fourcc in [('short.mp4', 100, 'mp4v'),
+                                                        ('long.mp4', 3000, 'mp4v'),
+                                                        ('long.avi', 3000, 'MJPG')]]
+    try:
+        for video_file in video_files:
+            benchmark(video_file)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,66 @@
+'''Time "import wxPyGameVideoPlayer" (and the headless display modules)
+in fresh interpreters and check they don't pull in any GUI toolkit or
+other heavy optional dependency
+
+Exits with status 1 if a median import time is over the budget or a
+forbidden module got imported, so it can guard against regressions.
+Usage: python benchmark_import_time.py [--repeat N] [--max-seconds S] [module ...]'''
+
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+import subprocess
+from collections import OrderedDict
+
+FORBIDDEN = ('wx', 'pygame', 'matplotlib', 'mpl_utils', 'skimage', 'pydub', 'attrdict')
+
+# module: the forbidden modules it is allowed to import anyway
+MODULES = OrderedDict([
+    ('wxPyGameVideoPlayer', ()),
+    ('wxPyGameVideoPlayer.renderers', ()),
+    ('wxPyGameVideoPlayer.pygame_interface', ('pygame',)),
+])
+
+CHILD = '''
+import sys, json, time
+t = time.time()
+import {module}
+seconds = time.time() - t
+print(json.dumps(dict(seconds=seconds,
+                      loaded=[m for m in {forbidden!r} if m in sys.modules])))
+'''
+
+def time_import(module):
+    '''Import time (s) in a fresh interpreter and the forbidden modules it loaded'''
+    code = CHILD.format(module=module, forbidden=FORBIDDEN)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return result['seconds'], result['loaded']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('modules', nargs='*', default=list(MODULES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=1.5)
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        times, loaded = [], set()
+        for _ in range(args.repeat):
+            seconds, modules = time_import(module)
+            times.append(seconds)
+            loaded.update(modules)
+        loaded.difference_update(MODULES.get(module, ()))
+        median = sorted(times)[len(times) // 2]
+        print('import {}: median {:.3f}s, min {:.3f}s, max {:.3f}s over {} runs'.format(
+            module, median, min(times), max(times), args.repeat))
+        if loaded:
+            print('FAIL: imported', ', '.join(sorted(loaded)))
+            failed = True
+        if median > args.max_seconds:
+            print('FAIL: over the {:.2f}s budget'.format(args.max_seconds))
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,50 @@
+'''Time showing one frame in the pygame window:
+   the old path (BGR->RGB copy, int32 copy, transpose, blit_array, scale)
+   vs. PygamePlotObject.imshow_bgr (uint8 BGR wrapped in place)
+
+Runs headless with SDL's dummy video driver.
+Usage: python benchmark_imshow.py [n_frames]'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+
+from wxPyGameVideoPlayer.pygame_interface import PygamePlotObject
+
+RESOLUTIONS = [('720p', (720, 1280)), ('1080p', (1080, 1920)), ('4K', (2160, 3840))]
+
+def old_imshow(plot_object, frame):
+    '''What displaying a frame cost before imshow_bgr'''
+    dat = np.array(frame)[:, :, ::-1] # get_opencv_frame_as_array
+    dat = np.asarray(dat, dtype=np.int32)
+    dat = np.transpose(dat, (1, 0, 2))
+    plot_object._check_screen_res(dat.shape[:2])
+    pygame.surfarray.blit_array(plot_object.scale_screen, dat)
+    temp = pygame.transform.scale(plot_object.scale_screen, plot_object.screen.get_size())
+    plot_object.screen.blit(temp, (0, 0))
+    pygame.display.update()
+
+def time_per_frame(show, plot_object, frames):
+    show(plot_object, frames[0]) # set up the window outside the timing
+    t = time.time()
+    for frame in frames:
+        show(plot_object, frame)
+    return (time.time() - t) / len(frames)
+
+if __name__ == '__main__':
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    plot_object = PygamePlotObject()
+    for name, shape in RESOLUTIONS:
+        frames = [np.random.randint(0, 256, shape + (3,), dtype=np.uint8)
+                  for _ in range(4)] * (n_frames // 4 + 1)
+        old = time_per_frame(old_imshow, plot_object, frames)
+        new = time_per_frame(PygamePlotObject.imshow_bgr, plot_object, frames)
+        print('{}: old {:.2f} ms/frame, imshow_bgr {:.2f} ms/frame ({:.1f}x)'.format(
+            name, 1000 * old, 1000 * new, old / new))
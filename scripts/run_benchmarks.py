@@ -0,0 +1,27 @@
+'''Run the headless decode/display benchmarks and save the results as JSON
+(see wxPyGameVideoPlayer.benchmarks)
+
+Usage: python run_benchmarks.py [--suite quick|full] [--output results.json]
+                                [--repeat N] [--only NAME ...] [video_file ...]
+With no video files, synthetic test videos are generated in a temp directory'''
+
+from __future__ import print_function
+
+import argparse
+
+from wxPyGameVideoPlayer import benchmarks
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('video_files', nargs='*',
+                        help='benchmark these instead of the synthetic videos')
+    parser.add_argument('--suite', default='quick', choices=sorted(benchmarks.SUITES))
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=list(benchmarks.BENCHMARKS),
+                        help='run just these benchmarks')
+    args = parser.parse_args()
+    benchmarks.run_benchmarks(args.suite, video_files=args.video_files or None,
+                              names=args.only, repeat=args.repeat,
+                              output_file=args.output)
+    print('Results written to', args.output)
@@ -16,7 +16,6 @@ setup(
     description='Just a simple video player using wxPython, PyGame, and OpenCV',
     long_description=open('README.md').read(),
     install_requires=[
-                      'attrdict>=2.0',
                       'numpy>=1.0',
                       'wxPython>=2.8',
                       'matplotlib>=1.0'
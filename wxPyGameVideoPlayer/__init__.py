@@ -1,9 +1,37 @@
+'''The decoding, caching and thumbnail core is imported right away and
+needs no GUI toolkit; the GUI modules (wx, pygame and matplotlib) and
+the benchmarks are only imported when first used, e.g.
+wxPyGameVideoPlayer.opencv_player or "from wxPyGameVideoPlayer import opencv_player"'''
+
 from __future__ import absolute_import
+
+import importlib
+
+from . import audio
+from . import cache_utils
 from . import cv2_utils
-from . import wx_func_utils
-from . import wx_video_ui
-from . import pygame_interface
-from . import opencv_player
+from . import decode_ahead
+from . import envelope
+from . import frame_cache
+from . import frame_index
+from . import frame_store
+from . import metrics
+from . import perf
+from . import playback_clock
+from . import proxy
+from . import scene_cuts
+from . import seek_service
 from . import thumbnails
 from . import _version
 from ._version import *
+
+LAZY_MODULES = ('benchmarks', 'wx_func_utils', 'wx_video_ui', 'pygame_interface',
+                'renderers', 'opencv_player')
+
+def __getattr__(name): # Python 3.7+ (PEP 562), elsewhere import the modules explicitly
+    if name in LAZY_MODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_MODULES))
@@ -0,0 +1,205 @@
+'''Stream a video's audio in chunks instead of loading it all at once
+
+Audio is decoded by an ffmpeg subprocess that writes raw int16 PCM to a
+pipe, which is read a chunk at a time. Chunks line up with video frame
+boundaries, so each one holds the audio for a whole number of frames.
+
+The decoded PCM can also be cached next to the video as a .npy file;
+later opens memory map it, which is instant and only costs page cache.
+A manifest next to the cache records the video's fingerprint, so the
+cache is only reused until the video changes.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import io
+import os
+import json
+import struct
+import subprocess
+
+import numpy as np
+
+from . import cv2_utils
+from .cache_utils import sidecar_filename, file_fingerprint, replace_file
+
+PCM_DTYPE = np.dtype('<i2') # what ffmpeg's s16le format writes
+AUDIO_CACHE_VERSION = 1
+
+DEVNULL = getattr(subprocess, 'DEVNULL', None)
+if DEVNULL is None: # Python 2
+    DEVNULL = open(os.devnull, 'w')
+
+def probe_audio(video_file):
+    '''Get the (sample_rate, channels) of the first audio stream using ffprobe'''
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+           '-show_entries', 'stream=sample_rate,channels', '-of', 'json', video_file]
+    streams = json.loads(subprocess.check_output(cmd).decode('utf-8'))['streams']
+    if not streams:
+        raise IOError('No audio stream found in {}'.format(video_file))
+    return int(streams[0]['sample_rate']), int(streams[0]['channels'])
+
+def _pcm_header(n_samples, channels, size=None):
+    '''The .npy header for (n_samples, channels) PCM, padded with spaces to
+       size bytes (so a header can be rewritten in place once the length
+       is known)'''
+    fid = io.BytesIO()
+    np.lib.format.write_array_header_1_0(fid, {'descr': np.lib.format.dtype_to_descr(PCM_DTYPE),
+                                               'fortran_order': False,
+                                               'shape': (n_samples, channels)})
+    header = fid.getvalue()
+    if size is not None and size > len(header):
+        n_pad = size - len(header)
+        header_len = struct.unpack('<H', header[8:10])[0] + n_pad
+        header = (header[:8] + struct.pack('<H', header_len) + header[10:-1] +
+                  b' ' * n_pad + b'\n')
+    return header
+
+def _read_exact(stream, n_bytes):
+    '''Read n_bytes from a pipe (fewer only at the end of the stream)'''
+    chunks = []
+    while n_bytes > 0:
+        chunk = stream.read(n_bytes)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b''.join(chunks)
+
+class AudioStream(object):
+    '''Chunked, frame aligned access to the audio track of a video file
+
+       Samples are int16 with shape (#samples, #channels), like mp4_to_array'''
+    def __init__(self, video_file, video_frame_rate=None, sample_rate=None, channels=None):
+        self.video_file = video_file
+        self.video_frame_rate = (video_frame_rate if video_frame_rate is not None else
+                                 cv2_utils.get_frame_rate(video_file))
+        if sample_rate is None or channels is None:
+            probed_rate, probed_channels = probe_audio(video_file)
+            sample_rate = probed_rate if sample_rate is None else sample_rate
+            channels = probed_channels if channels is None else channels
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.cache_file = sidecar_filename(video_file, 'audio_pcm', '.npy')
+        self._samples = None # memory mapped cache, once loaded
+
+    def frame_to_sample(self, frame_number):
+        '''The first sample of a video frame'''
+        return int(round(frame_number * self.sample_rate / self.video_frame_rate))
+
+    def _ffmpeg(self, start_sample=0):
+        cmd = ['ffmpeg', '-v', 'error']
+        if start_sample:
+            cmd += ['-ss', repr(start_sample / self.sample_rate)]
+        cmd += ['-i', self.video_file, '-vn', '-f', 's16le', '-acodec', 'pcm_s16le',
+                '-ar', str(self.sample_rate), '-ac', str(self.channels), '-']
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=DEVNULL,
+                                bufsize=1 << 20)
+
+    def iter_chunks(self, frames_per_chunk=1, start_frame=0):
+        '''Yield (first_frame, samples) with the audio for frames_per_chunk
+           video frames at a time, starting at start_frame'''
+        samples = self.load_cache()
+        frame_number = start_frame
+        if samples is not None:
+            while True:
+                a = self.frame_to_sample(frame_number)
+                b = self.frame_to_sample(frame_number + frames_per_chunk)
+                if a >= len(samples):
+                    return
+                yield frame_number, samples[a:b]
+                frame_number += frames_per_chunk
+
+        proc = self._ffmpeg(self.frame_to_sample(start_frame))
+        bytes_per_sample = 2 * self.channels
+        try:
+            while True:
+                n_samples = (self.frame_to_sample(frame_number + frames_per_chunk) -
+                             self.frame_to_sample(frame_number))
+                data = _read_exact(proc.stdout, n_samples * bytes_per_sample)
+                n_read = len(data) // bytes_per_sample
+                if n_read == 0:
+                    return
+                yield frame_number, np.frombuffer(data[:n_read * bytes_per_sample],
+                                                  dtype=PCM_DTYPE).reshape(n_read, self.channels)
+                frame_number += frames_per_chunk
+        finally:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+
+    def read_samples(self, start_sample, stop_sample):
+        '''Samples [start_sample, stop_sample), from the cache if there is one'''
+        samples = self.load_cache()
+        if samples is not None:
+            return samples[start_sample:stop_sample]
+        proc = self._ffmpeg(start_sample)
+        bytes_per_sample = 2 * self.channels
+        try:
+            data = _read_exact(proc.stdout, max(stop_sample - start_sample, 0) * bytes_per_sample)
+        finally:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+        n_read = len(data) // bytes_per_sample
+        return np.frombuffer(data[:n_read * bytes_per_sample],
+                             dtype=PCM_DTYPE).reshape(n_read, self.channels)
+
+    def window(self, frame_number, n_before=0, n_after=1):
+        '''The audio for frames [frame_number - n_before, frame_number + n_after)'''
+        start_frame = max(frame_number - n_before, 0)
+        samples = self.load_cache()
+        if samples is not None:
+            return samples[self.frame_to_sample(start_frame):
+                           self.frame_to_sample(frame_number + n_after)]
+        n_frames = frame_number + n_after - start_frame
+        for _, chunk in self.iter_chunks(n_frames, start_frame):
+            return np.array(chunk)
+        return np.zeros((0, self.channels), dtype=PCM_DTYPE)
+
+    def _manifest(self):
+        '''What the cache was decoded from (saved next to it as json)'''
+        return dict(version=AUDIO_CACHE_VERSION, fingerprint=file_fingerprint(self.video_file),
+                    sample_rate=self.sample_rate, channels=self.channels)
+
+    def load_cache(self):
+        '''Memory map the cached PCM if it is there and was decoded from
+           this version of the video (with the same rate and channels)'''
+        if self._samples is None and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file + '.json') as fid:
+                    manifest = json.load(fid)
+                if manifest == self._manifest():
+                    self._samples = np.load(self.cache_file, mmap_mode='r')
+            except (IOError, OSError, ValueError):
+                pass
+        return self._samples
+
+    def build_cache(self, chunk_frames=1000):
+        '''Decode the whole track into the .npy cache (streaming, so memory
+           use stays at one chunk) and return it memory mapped'''
+        if self.load_cache() is not None:
+            return self._samples
+        # The length is only known at the end, so the header is written
+        # with room for any length first and filled in after the samples
+        manifest = self._manifest() # before decoding, in case the video changes meanwhile
+        temp_file = self.cache_file + '.tmp'
+        header = _pcm_header(10**18, self.channels)
+        n_samples = 0
+        try:
+            with open(temp_file, 'wb') as fid:
+                fid.write(header)
+                for _, chunk in self.iter_chunks(chunk_frames):
+                    fid.write(chunk.tobytes())
+                    n_samples += len(chunk)
+                fid.seek(0)
+                fid.write(_pcm_header(n_samples, self.channels, size=len(header)))
+            replace_file(temp_file, self.cache_file)
+            temp_file = None # kept
+        finally:
+            if temp_file is not None and os.path.exists(temp_file): # failed part way
+                os.remove(temp_file)
+        with open(self.cache_file + '.json.tmp', 'w') as fid:
+            json.dump(manifest, fid)
+        replace_file(self.cache_file + '.json.tmp', self.cache_file + '.json')
+        return self.load_cache()
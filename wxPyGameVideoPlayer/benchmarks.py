@@ -0,0 +1,227 @@
+'''Headless benchmarks of the decode and display pipeline
+
+Synthetic test videos are written locally with cv2.VideoWriter (see
+cv2_utils.write_test_video) in a few codecs, resolutions and lengths,
+and each benchmark is timed on each video. Nothing needs a screen:
+pygame runs on SDL's dummy video driver.
+
+run_benchmarks returns (and can save) a JSON-friendly dict with the
+environment (versions, git commit) and one record per (video, benchmark),
+so results from different commits can be compared.
+scripts/run_benchmarks.py is the command line front end.'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+from . import cv2_utils
+from . import decode_ahead
+from . import frame_cache
+from . import frame_index
+from .playback_clock import now
+
+# name: (fourcc, extension, (height, width), number of frames)
+SUITES = {
+    'quick': OrderedDict([
+        ('mp4v_240p_300', ('mp4v', '.mp4', (240, 320), 300)),
+        ('mjpg_240p_300', ('MJPG', '.avi', (240, 320), 300)),
+    ]),
+    'full': OrderedDict([
+        ('mp4v_240p_300', ('mp4v', '.mp4', (240, 320), 300)),
+        ('mjpg_240p_300', ('MJPG', '.avi', (240, 320), 300)),
+        ('xvid_240p_300', ('XVID', '.avi', (240, 320), 300)),
+        ('mp4v_720p_300', ('mp4v', '.mp4', (720, 1280), 300)),
+        ('mjpg_720p_300', ('MJPG', '.avi', (720, 1280), 300)),
+        ('mp4v_240p_3000', ('mp4v', '.mp4', (240, 320), 3000)),
+        ('xvid_720p_3000', ('XVID', '.avi', (720, 1280), 3000)),
+    ]),
+}
+
+def make_test_videos(directory, videos):
+    '''Write the synthetic videos (a name -> spec dict like SUITES['quick'])
+       Codecs this OpenCV build can't write are skipped
+       Returns an OrderedDict of name -> filename'''
+    filenames = OrderedDict()
+    for name, (fourcc, ext, shape, num_frames) in videos.items():
+        filename = os.path.join(directory, name + ext)
+        try:
+            cv2_utils.write_test_video(filename, num_frames=num_frames,
+                                       shape=shape, fourcc=fourcc)
+        except IOError:
+            print('Skipping {}: no {} writer'.format(name, fourcc))
+            continue
+        filenames[name] = filename
+    return filenames
+
+def _timed(func, *args, **kwds):
+    t = now()
+    result = func(*args, **kwds)
+    return result, now() - t
+
+def bench_random_seek(video_file, n_seeks=50, seed=0):
+    '''Read random frames (exact seeks with a frame index)'''
+    index = frame_index.get_frame_index(video_file)
+    frame_numbers = np.random.RandomState(seed).randint(0, len(index), n_seeks)
+    with cv2_utils.VideoReader(video_file, index=index) as reader:
+        reader.read(0) # open and warm up outside the timing
+        t = now()
+        for frame_number in frame_numbers:
+            reader.read(frame_number)
+        seconds = now() - t
+    return dict(seconds=seconds, n=n_seeks, per_item=seconds / n_seeks)
+
+def bench_sequential_decode(video_file):
+    '''Decode every frame in order'''
+    with cv2_utils.VideoReader(video_file) as reader:
+        ret, frame = reader.read(0)
+        n = 1
+        t = now()
+        while reader.read(out=frame)[0]:
+            n += 1
+        seconds = now() - t
+    return dict(seconds=seconds, n=n, per_item=seconds / max(n - 1, 1),
+                fps=(n - 1) / max(seconds, 1e-9))
+
+def bench_reverse_playback(video_file, n_frames=100):
+    '''Pull frames backwards from the end through the decode-ahead thread'''
+    index = frame_index.get_frame_index(video_file)
+    n_frames = min(n_frames, len(index))
+    decoder = decode_ahead.DecodeAheadThread(video_file, num_frames=len(index), index=index)
+    decoder.start()
+    try:
+        last = len(index) - 1
+        t = now()
+        decoder.retarget(last, -1)
+        n_missed = sum(decoder.get_frame(frame_number, timeout=5.) is None
+                       for frame_number in range(last, last - n_frames, -1))
+        seconds = now() - t
+    finally:
+        decoder.close()
+    return dict(seconds=seconds, n=n_frames, per_item=seconds / n_frames,
+                fps=n_frames / max(seconds, 1e-9), n_missed=n_missed)
+
+def bench_binary_search_end(video_file):
+    result, seconds = _timed(cv2_utils.binary_search_end, video_file)
+    return dict(seconds=seconds, n_frames=int(result) + 1)
+
+def bench_count_frames(video_file):
+    result, seconds = _timed(cv2_utils.count_frames, video_file)
+    return dict(seconds=seconds, n_frames=int(result))
+
+def bench_thumb_grid(video_file, grid_shape=(4, 4), n_workers=None):
+    '''Build a contact sheet grid (no frame cache, so every frame is decoded)'''
+    from . import thumbnails
+    grid = thumbnails.evenly_spaced_frame_grid(cv2_utils.count_frames(video_file), grid_shape)
+    _, seconds = _timed(thumbnails.thumb_grid_from_video_frames, video_file, grid,
+                        cache=frame_cache.FrameCache(), n_workers=n_workers)
+    return dict(seconds=seconds, n=grid.size, per_item=seconds / grid.size)
+
+def _bench_pygame_show(video_file, n_frames, show):
+    '''Time show(plot_object, bgr_frame) on decoded frames in a pygame
+       window (on SDL's dummy driver)'''
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    from .pygame_interface import PygamePlotObject
+    with cv2_utils.VideoReader(video_file) as reader:
+        frames = [reader.read()[1] for _ in range(min(n_frames, 8))]
+    frames = [frame for frame in frames if frame is not None]
+    plot_object = PygamePlotObject()
+    show(plot_object, frames[0]) # set up the window outside the timing
+    t = now()
+    for i in range(n_frames):
+        show(plot_object, frames[i % len(frames)])
+    seconds = now() - t
+    return dict(seconds=seconds, n=n_frames, per_item=seconds / n_frames)
+
+def bench_imshow(video_file, n_frames=60):
+    '''Show frames with PygamePlotObject.imshow (an RGB view, transposed
+       and blitted through surfarray)'''
+    return _bench_pygame_show(video_file, n_frames,
+                              lambda plot_object, frame: plot_object.imshowT(frame[:, :, ::-1]))
+
+def bench_imshow_bgr(video_file, n_frames=60):
+    '''Show frames with PygamePlotObject.imshow_bgr (wrapped in place)'''
+    return _bench_pygame_show(video_file, n_frames,
+                              lambda plot_object, frame: plot_object.imshow_bgr(frame))
+
+BENCHMARKS = OrderedDict([
+    ('random_seek', bench_random_seek),
+    ('sequential_decode', bench_sequential_decode),
+    ('reverse_playback', bench_reverse_playback),
+    ('binary_search_end', bench_binary_search_end),
+    ('count_frames', bench_count_frames),
+    ('thumb_grid', bench_thumb_grid),
+    ('imshow', bench_imshow),
+    ('imshow_bgr', bench_imshow_bgr),
+])
+
+def environment():
+    '''Versions and the git commit, to tell result files apart'''
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.realpath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([('python', platform.python_version()),
+                        ('platform', platform.platform()),
+                        ('numpy', np.__version__),
+                        ('opencv', cv2.__version__),
+                        ('cpu_count', os.cpu_count() if hasattr(os, 'cpu_count') else None),
+                        ('git_commit', commit)])
+
+def run_benchmarks(suite='quick', video_files=None, names=None, repeat=3,
+                   output_file=None, verbose=True):
+    '''Run the benchmarks (all of BENCHMARKS, or just names) on the
+       synthetic videos of a suite, or on existing video_files instead
+
+       Each benchmark runs repeat times on each video; the records keep
+       every run and the best one. Failures are recorded, not raised.
+       If output_file is given, the results are written to it as JSON.'''
+    names = list(BENCHMARKS) if names is None else names
+    temp_dir = None
+    if video_files is None:
+        temp_dir = tempfile.mkdtemp(prefix='wxPyGameVideoPlayer_bench_')
+        videos = make_test_videos(temp_dir, SUITES[suite])
+    else:
+        videos = OrderedDict((os.path.basename(f), f) for f in video_files)
+    records = []
+    try:
+        for video_name, video_file in videos.items():
+            frame_index.get_frame_index(video_file) # build the index outside the timings
+            for name in names:
+                record = OrderedDict([('video', video_name), ('benchmark', name)])
+                try:
+                    runs = [BENCHMARKS[name](video_file) for _ in range(repeat)]
+                    record['runs'] = runs
+                    record['best_seconds'] = min(run['seconds'] for run in runs)
+                except Exception as e:
+                    record['error'] = '{}: {}'.format(type(e).__name__, e)
+                records.append(record)
+                if verbose:
+                    print('{:<16} {:<18} {}'.format(
+                        video_name, name,
+                        record.get('error') or '{:.4f}s'.format(record['best_seconds'])))
+                    sys.stdout.flush()
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    results = OrderedDict([('environment', environment()),
+                           ('suite', suite if video_files is None else None),
+                           ('repeat', repeat),
+                           ('results', records)])
+    if output_file is not None:
+        with open(output_file, 'w') as fid:
+            json.dump(results, fid, indent=2)
+    return results
@@ -0,0 +1,54 @@
+'''Helpers for the files cached alongside a video (indexes, proxies, traces...)'''
+
+from __future__ import absolute_import
+
+import os
+import hashlib
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'wxPyGameVideoPlayer')
+
+def sidecar_filename(video_file, tag, ext):
+    '''Get the name of a cache file that lives next to a video
+       (movie.mp4 -> movie.mp4.<tag><ext>)
+       If the video's directory isn't writable, use CACHE_DIR instead'''
+    video_file = os.path.abspath(video_file)
+    video_dir, video_name = os.path.split(video_file)
+    if not os.access(video_dir, os.W_OK):
+        return local_cache_filename(video_file, tag, ext)
+    return os.path.join(video_dir, '{}.{}{}'.format(video_name, tag, ext))
+
+def local_cache_filename(video_file, tag, ext):
+    '''Like sidecar_filename, but always in CACHE_DIR on the local disk
+       (for big caches that shouldn't sit next to videos on a network share)'''
+    video_file = os.path.abspath(video_file)
+    path_hash = hashlib.sha1(video_file.encode('utf-8')).hexdigest()[:12]
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    return os.path.join(CACHE_DIR, '{}_{}.{}{}'.format(path_hash, os.path.basename(video_file),
+                                                       tag, ext))
+
+def file_signature(filename):
+    '''A (size, mtime) pair that changes whenever the file is rewritten'''
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+def file_fingerprint(filename, n_blocks=8, block_size=1 << 16):
+    '''A cheap content fingerprint: a hash of the size, the mtime and
+       n_blocks evenly spaced blocks of the file (so multi-GB videos
+       only cost a few small reads)'''
+    size, mtime = file_signature(filename)
+    h = hashlib.sha1('{} {!r}'.format(size, mtime).encode('utf-8'))
+    with open(filename, 'rb') as fid:
+        for i in range(n_blocks):
+            fid.seek(max(size - block_size, 0) * i // max(n_blocks - 1, 1))
+            h.update(fid.read(block_size))
+    return h.hexdigest()
+
+def replace_file(temp_filename, filename):
+    '''Move a finished temp file into place (atomically where possible)'''
+    if hasattr(os, 'replace'):
+        os.replace(temp_filename, filename)
+    else:
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp_filename, filename)
@@ -1,15 +1,15 @@
 # coding: utf-8
 
+from __future__ import absolute_import
 from __future__ import print_function
 
+import threading
+
 import numpy as np
 import cv2
 
-try:
-    import pydub
-except ImportError:
-    print('\n'.join(('Warning, pydub is not installed!',
-                     '"mp4_to_array" cannot be used!')))
+from .frame_index import get_frame_index
+from .playback_clock import now
 
 def get_msec_to_frame(frame_rate):
     '''Get the function to convert from frame time (ms) to frame number'''
@@ -41,43 +41,370 @@ def set_opencv_position(cap, frame_number, frame_rate=None):
        
        THIS WILL ONLY WORK ONE TIME FOR SOME REASON.
        After that it reverts to the original position!
-       I assume this is some kind of OpenCV bug.'''
+       I assume this is some kind of OpenCV bug.
+       
+       For exact seeking, use a VideoReader with a FrameIndex instead.'''
     frame_rate = (frame_rate if frame_rate is not None else
                   cap.get(cv2.CAP_PROP_FPS))
     frame_time = get_frame_to_msec(frame_rate)(frame_number)
     return cap.set(cv2.CAP_PROP_POS_MSEC, frame_time)
 
+PIXEL_FORMATS = ('bgr', 'rgb', 'gray', 'yuv420')
+
+def open_capture(video_file, n_threads=None):
+    '''Open a cv2.VideoCapture, asking for n_threads decoding threads
+       (ignored by OpenCV builds that can't set this at open time)'''
+    if n_threads is not None and hasattr(cv2, 'CAP_PROP_N_THREADS'):
+        cap = cv2.VideoCapture(video_file, cv2.CAP_ANY,
+                               [cv2.CAP_PROP_N_THREADS, int(n_threads)])
+        if cap.isOpened():
+            return cap
+    return cv2.VideoCapture(video_file)
+
+def convert_frame(frame, pixel_format='bgr', downscale=1, out=None):
+    '''Convert a decoded BGR frame to another pixel format and/or shrink
+       it by an integer factor
+       
+       Downscaling happens first, so the colour conversion only touches
+       the pixels that are kept.
+       pixel_format is one of PIXEL_FORMATS; "yuv420" gives the planar
+       I420 layout, shape (3 * H // 2, W)'''
+    if downscale != 1:
+        height, width = frame.shape[:2]
+        size = (max(width // downscale, 1), max(height // downscale, 1))
+        frame = cv2.resize(frame, size, dst=(out if pixel_format == 'bgr' else None),
+                           interpolation=cv2.INTER_AREA)
+    if pixel_format == 'bgr':
+        if out is not None and frame is not out:
+            out[...] = frame
+            return out
+        return frame
+    code = {'rgb': cv2.COLOR_BGR2RGB,
+            'gray': cv2.COLOR_BGR2GRAY,
+            'yuv420': cv2.COLOR_BGR2YUV_I420}[pixel_format]
+    return (cv2.cvtColor(frame, code) if out is None else
+            cv2.cvtColor(frame, code, dst=out))
+
+class VideoReader(object):
+    '''Keep a cv2.VideoCapture open across frame requests
+       
+       Opening the container, initializing the codec and seeking to a
+       keyframe is far more expensive than decoding one more frame, so
+       sequential requests (and short jumps forward) are served with plain
+       grab/read calls and only real jumps pay for a seek.
+       
+       With a FrameIndex (see frame_index.py), seeks go to the preceding
+       keyframe and decode forward from there, so every frame costs at
+       most one GOP to reach. The keyframe is sought by frame number, so
+       on variable frame rate files this is only as exact as OpenCV's
+       own (average frame rate based) frame positions. The index can be
+       attached later with set_index, e.g. once it is built.
+       
+       Decode options:
+           n_threads: number of decoding threads (None lets OpenCV choose)
+           pixel_format: output format, one of PIXEL_FORMATS
+           downscale: integer factor to shrink frames by right after decoding
+       so consumers never pay for a conversion or resolution they won't use.
+       
+       If timings (a perf.StageTimings) is given, the seek, decode and
+       convert time of every read is recorded in it.
+       
+       A lock guards the capture so the reader can be shared between the
+       wx thread and the pygame thread.'''
+    max_forward_grab = 30 # without an index, decoding more frames than this
+                          # to reach the target costs more than seeking
+    
+    def __init__(self, video_file, frame_rate=None, index=None,
+                 n_threads=None, pixel_format='bgr', downscale=1, timings=None):
+        assert pixel_format in PIXEL_FORMATS, 'Unknown pixel format ' + repr(pixel_format)
+        self.video_file = video_file
+        self.cap = open_capture(video_file, n_threads)
+        self.frame_rate = (frame_rate if frame_rate is not None else
+                           self.cap.get(cv2.CAP_PROP_FPS))
+        self.index = index
+        self.pixel_format = pixel_format
+        self.downscale = int(downscale)
+        self.timings = timings
+        self._decoded = None # reused for the native frame when converting
+        self.next_frame = 0 # the frame number a plain read will return
+                            # (None means unknown, so always seek)
+        self.lock = threading.RLock()
+    
+    @property
+    def converts(self):
+        return self.pixel_format != 'bgr' or self.downscale != 1
+    
+    @property
+    def format_key(self):
+        '''Identifies the output format, e.g. for frame cache keys'''
+        return (self.pixel_format if self.downscale == 1 else
+                '{}/{}'.format(self.pixel_format, self.downscale))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.release()
+    
+    def release(self):
+        with self.lock:
+            self.cap.release()
+            self.next_frame = None
+    
+    def seek(self, frame_number):
+        '''Move the capture so the next read returns frame_number'''
+        with self.lock:
+            if self.index is None:
+                set_opencv_position(self.cap, frame_number, self.frame_rate)
+                self.next_frame = frame_number
+            else:
+                self._seek_indexed(frame_number)
+    
+    def set_index(self, index):
+        '''Use a FrameIndex for seeks from now on (None to stop using one)'''
+        with self.lock:
+            self.index = index
+    
+    def _seek_indexed(self, frame_number):
+        '''Seek to the keyframe at or before frame_number, then decode forward'''
+        if frame_number >= len(self.index):
+            self.next_frame = None
+            return False
+        keyframe = self.index.keyframe_before(frame_number)
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+        self.next_frame = keyframe
+        return self._grab_forward(frame_number - keyframe)
+    
+    def _grab_forward(self, n_frames):
+        for _ in range(n_frames):
+            if not self.cap.grab():
+                self.next_frame = None
+                return False
+            self.next_frame += 1
+        return True
+    
+    def _move_to(self, frame_number):
+        '''Decode forward when that is cheaper than a seek'''
+        offset = (None if self.next_frame is None else
+                  frame_number - self.next_frame)
+        if self.index is not None:
+            if (offset is not None and offset >= 0 and
+                self.index.keyframe_before(frame_number) <= self.next_frame):
+                return self._grab_forward(offset)
+            return self._seek_indexed(frame_number)
+        if offset is None or not 0 <= offset <= self.max_forward_grab:
+            self.seek(frame_number)
+            return True
+        return self._grab_forward(offset)
+    
+    def read(self, frame_number=None, out=None):
+        '''Read a frame (the next one if frame_number is None)
+           Returns (ret, frame) just like cv2.VideoCapture.read
+           If out is given (with the right shape and dtype), the frame
+           is written into it instead of a newly allocated array'''
+        timings = self.timings
+        with self.lock:
+            t = now() if timings is not None else None
+            if frame_number is not None and frame_number != self.next_frame:
+                frame_number = int(frame_number)
+                if not self._move_to(frame_number):
+                    return False, None
+                if timings is not None:
+                    t = timings.lap('seek', frame_number, t)
+            timed_frame = -1 if self.next_frame is None else self.next_frame
+            if not self.converts:
+                ret, frame = (self.cap.read() if out is None else
+                              self.cap.read(out))
+                if timings is not None:
+                    timings.lap('decode', timed_frame, t)
+            else:
+                ret, self._decoded = self.cap.read(self._decoded)
+                if timings is not None:
+                    t = timings.lap('decode', timed_frame, t)
+                frame = (convert_frame(self._decoded, self.pixel_format,
+                                       self.downscale, out=out)
+                         if ret else None)
+                if timings is not None:
+                    timings.lap('convert', timed_frame, t)
+            self.next_frame = (None if not ret or self.next_frame is None else
+                               self.next_frame + 1)
+            return ret, frame
+    
+    def grab(self, frame_number=None):
+        '''Like read, but skip retrieving (converting) the frame'''
+        with self.lock:
+            if frame_number is not None:
+                frame_number = int(frame_number)
+                if not self._move_to(frame_number):
+                    return False
+            ret = self.cap.grab()
+            self.next_frame = (None if not ret or self.next_frame is None else
+                               self.next_frame + 1)
+            return ret
+
 def get_opencv_frame(video_file, frame_number, frame_rate=None):
-    '''Get a single frame from a video file using OpenCV'''
+    '''Get a single frame from a video file using OpenCV
+       video_file can also be an open VideoReader, which avoids
+       reopening the file for every frame'''
+    if isinstance(video_file, VideoReader):
+        return video_file.read(frame_number)
     cap = cv2.VideoCapture(video_file)
     set_opencv_position(cap, frame_number, frame_rate)
     ret, frame = cap.read()
     cap.release()
     return ret, frame
 
+def get_frames(video_file, frame_numbers, out=None, cache=None):
+    '''Load many frames with a single forward sweep through the video
+       
+       frame_numbers can be any shape (e.g. a 2d grid for a contact sheet);
+       the result has shape frame_numbers.shape + frame_shape, in the
+       caller's layout. Requests are deduplicated and sorted, so frames
+       that share a GOP are decoded in one pass from their keyframe
+       (given a reader with a FrameIndex, otherwise the index is loaded)
+       and every decoded frame is written straight into the output array.
+       Frames that can't be read are left black.
+       
+       out is an optional preallocated (C-contiguous) output array and cache an optional
+       frame_cache.FrameCache to take already decoded frames from'''
+    frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+    own_reader = not isinstance(video_file, VideoReader)
+    reader = (VideoReader(video_file, index=get_frame_index(video_file))
+              if own_reader else video_file)
+    try:
+        flat_numbers = frame_numbers.ravel()
+        unique, first_positions, inverse = np.unique(flat_numbers, return_index=True,
+                                                     return_inverse=True)
+        out_flat = None
+        for frame_number, pos in zip(unique, first_positions):
+            key = (reader.video_file, int(frame_number), reader.format_key)
+            cached = None if cache is None else cache.get(key)
+            if out_flat is None: # learn the frame shape from the first frame
+                first = cached if cached is not None else reader.read(frame_number)[1]
+                if first is None:
+                    continue
+                if out is None:
+                    out = np.zeros(frame_numbers.shape + first.shape, dtype=first.dtype)
+                out_flat = out.reshape((-1,) + first.shape)
+                out_flat[pos] = first
+            elif cached is not None:
+                out_flat[pos] = cached
+            else:
+                ret, frame = reader.read(frame_number, out=out_flat[pos])
+                if not ret:
+                    out_flat[pos] = 0
+        if out_flat is not None: # fill in the duplicates
+            source = first_positions[inverse.ravel()]
+            duplicates = np.nonzero(source != np.arange(len(source)))[0]
+            out_flat[duplicates] = out_flat[source[duplicates]]
+        return out
+    finally:
+        if own_reader:
+            reader.release()
+
 def binary_search_end(video_file, max_time=2**22, n_extra = 2):
     '''Find the last frame number that returns a valid frame
        The maximum possible length is 18 hours at 60 fps.
-       Yes, it's overkill. Whatever.'''
+       Yes, it's overkill. Whatever.
+       
+       This takes ~24 seeks, so prefer count_frames, which only falls
+       back to this when the container metadata can't be trusted'''
     bottom, top = 0, max_time
     max_iters = int(np.ceil(np.log(max_time)/np.log(2))) + n_extra
-    frame_rate = get_frame_rate(video_file)
+    frame_rate = (video_file.frame_rate if isinstance(video_file, VideoReader) else
+                  get_frame_rate(video_file))
     for ms in range(max_iters):
-        middle = (bottom + top) / 2
+        middle = (bottom + top) // 2
         ret, _ = get_opencv_frame(video_file, middle, frame_rate) # Do a frame grab at the middle
         bottom, top = ((middle, top) if ret else
                        (bottom, middle))
     return bottom
 
-def get_opencv_frame_as_array(video_file, frame_number, frame_rate=None):
-    '''If this is a valid frame, return it as a numpy array'''
-    ret, frame = get_opencv_frame(video_file, frame_number,
-                                  frame_rate=frame_rate)
-    return (np.array(frame)[:, :, ::-1] if ret else frame)
+def get_metadata_frame_count(cap):
+    '''Estimate the number of frames from the container metadata
+       Uses the frame count if the container reports one, otherwise the
+       duration times the frame rate (this moves the capture position!)
+       Returns None if neither is available'''
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    if frame_count > 0:
+        return int(round(frame_count))
+    frame_rate = cap.get(cv2.CAP_PROP_FPS)
+    if frame_rate > 0 and cap.set(cv2.CAP_PROP_POS_AVI_RATIO, 1):
+        duration = cap.get(cv2.CAP_PROP_POS_MSEC)
+        if duration > 0:
+            return int(round(get_msec_to_frame(frame_rate)(duration))) + 1
+    return None
+
+def count_frames(video_file, n_slack=2):
+    '''Get the number of frames in a video file (or open VideoReader)
+       
+       The metadata estimate is confirmed with a single seek to just
+       before the reported end and a few grabs: the estimate is accepted
+       if the stream runs out within n_slack frames of it (metadata is
+       often off by a frame or so).
+       Only if that fails does this fall back to binary_search_end'''
+    reader = (video_file if isinstance(video_file, VideoReader) else
+              VideoReader(video_file))
+    try:
+        with reader.lock:
+            estimate = get_metadata_frame_count(reader.cap)
+            reader.next_frame = None # the duration probe may have moved the capture
+            if estimate is not None:
+                start = max(estimate - n_slack - 1, 0)
+                reader.seek(start)
+                last_good = None
+                for frame_number in range(start, estimate + n_slack + 1):
+                    if not reader.grab():
+                        break
+                    last_good = frame_number
+                else:
+                    last_good = None # still going, so the metadata is wrong
+                if last_good is not None:
+                    return last_good + 1
+            return binary_search_end(reader) + 1
+    finally:
+        if reader is not video_file:
+            reader.release()
+
+def get_opencv_frame_as_array(video_file, frame_number, frame_rate=None,
+                              pixel_format='rgb', downscale=1, n_threads=None):
+    '''If this is a valid frame, return it as a numpy array
+       (see convert_frame for pixel_format and downscale)
+       video_file can also be an open (BGR) VideoReader'''
+    if not isinstance(video_file, VideoReader):
+        with VideoReader(video_file, frame_rate, n_threads=n_threads) as reader:
+            return get_opencv_frame_as_array(reader, frame_number,
+                                             pixel_format=pixel_format,
+                                             downscale=downscale)
+    ret, frame = video_file.read(frame_number)
+    return (convert_frame(frame, pixel_format, downscale) if ret else frame)
+
+def write_test_video(video_file, num_frames=100, shape=(240, 320),
+                     frame_rate=30, fourcc='mp4v'):
+    '''Write a synthetic video with the frame number printed on each frame
+       Handy for benchmarks and for checking seek accuracy'''
+    height, width = shape
+    writer = cv2.VideoWriter(video_file, cv2.VideoWriter_fourcc(*fourcc),
+                             frame_rate, (width, height))
+    if not writer.isOpened():
+        raise IOError('Could not open a {} writer for {}'.format(fourcc, video_file))
+    ramp = np.linspace(0, 255, width).astype(np.uint8)
+    for i in range(num_frames):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = np.roll(ramp, 7 * i)[None, :, None]
+        cv2.putText(frame, str(i), (width // 8, height // 2),
+                    cv2.FONT_HERSHEY_SIMPLEX, height / 100., (0, 0, 255), 3)
+        writer.write(frame)
+    writer.release()
+    return video_file
 
 def mp4_to_array(f):
     '''Read audio straight from a movie file using pydub (and indirectly ffmpeg)
-       Returns the frame rate and the actual array with shape (#frames, #channels)'''
+       Returns the frame rate and the actual array with shape (#frames, #channels)
+       
+       This loads the whole track into memory; for long recordings use
+       audio.AudioStream, which streams it in chunks and caches it on disk'''
+    import pydub # optional, and slow to import
     aud = pydub.AudioSegment.from_file(f)
     frame_rate = aud.frame_rate
     frame_count = aud.frame_count()
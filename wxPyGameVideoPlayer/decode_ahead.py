@@ -0,0 +1,355 @@
+'''Decode frames ahead of the play head in a background thread
+
+The decoder thread fills a bounded ring of preallocated frame buffers
+in the current play direction while the display thread only pulls
+finished frames out and presents them, so a slow frame to decode no
+longer turns directly into a late frame on screen.
+
+Playing backwards, frames come from a ReverseChunkDecoder, which decodes
+whole GOPs forward in one pass and serves them back in reverse, while
+the chunk before it is decoded on a worker thread.
+That makes reverse cost about the same as forward playback instead of
+one seek plus up to a GOP of decoding per frame.'''
+
+from __future__ import absolute_import
+
+import threading
+
+import numpy as np
+
+from . import cv2_utils
+
+class FrameRingBuffer(object):
+    '''A fixed set of preallocated frame slots with one producer and one consumer
+
+       Frames are handed out as views into the slots. The consumer owns the
+       slot from its last get until the next get (or release), so the
+       producer never writes into a frame that is still being presented.'''
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.frames = None # (capacity, H, W, C), allocated from the first frame
+        self.frame_numbers = [None] * capacity
+        self.condition = threading.Condition()
+        self.generation = 0 # bumped by clear so in-flight decodes get dropped
+        self._clear_slots()
+        self.held = False
+
+    def _clear_slots(self):
+        self.read_pos = 0
+        self.write_pos = 0
+        self.count = 0
+
+    def allocate(self, frame_shape, dtype=np.uint8):
+        with self.condition:
+            if self.frames is None or self.frames.shape[1:] != tuple(frame_shape):
+                self.frames = np.empty((self.capacity,) + tuple(frame_shape), dtype=dtype)
+                self._clear_slots()
+                self.held = False
+
+    def clear(self):
+        '''Drop everything buffered (but not the slot the consumer holds)'''
+        with self.condition:
+            self.generation += 1
+            # Rewind the producer rather than skipping the reader ahead: the
+            # held slot (just before read_pos) stays the last one it reaches
+            self.write_pos = self.read_pos
+            self.count = 0
+            self.condition.notify_all()
+
+    def n_free(self):
+        return self.capacity - self.count - int(self.held)
+
+    def reserve(self):
+        '''Producer: wait for a free slot, return (slot, generation)'''
+        with self.condition:
+            while self.n_free() <= 0:
+                self.condition.wait()
+            return self.write_pos, self.generation
+
+    def commit(self, slot, generation, frame_number):
+        '''Producer: publish a decoded slot (dropped if clear was called meanwhile)'''
+        with self.condition:
+            if generation != self.generation or slot != self.write_pos:
+                return False
+            self.frame_numbers[slot] = frame_number
+            self.write_pos = (self.write_pos + 1) % self.capacity
+            self.count += 1
+            self.condition.notify_all()
+            return True
+
+    def release(self):
+        '''Consumer: done with the frame from the last get'''
+        with self.condition:
+            if self.held:
+                self.held = False
+                self.condition.notify_all()
+
+    def get(self, frame_number, step=1, timeout=None):
+        '''Consumer: wait for frame_number, dropping buffered frames before it
+           (in the play direction given by step)
+           Returns a view of the frame, or None on timeout'''
+        with self.condition:
+            if self.held:
+                self.held = False
+                self.condition.notify_all()
+            while True:
+                while self.count > 0:
+                    slot = self.read_pos
+                    buffered = self.frame_numbers[slot]
+                    if step * (buffered - frame_number) > 0: # already past it
+                        return None
+                    self.read_pos = (self.read_pos + 1) % self.capacity
+                    self.count -= 1
+                    self.condition.notify_all()
+                    if buffered == frame_number:
+                        self.held = True
+                        return self.frames[slot]
+                if not self.condition.wait(timeout) and timeout is not None:
+                    return None
+
+class _Chunk(object):
+    __slots__ = ('start', 'end', 'frames', 'buffer_id')
+    def __init__(self, start, frames, buffer_id):
+        self.start = start
+        self.end = start + len(frames) - 1
+        self.frames = frames
+        self.buffer_id = buffer_id
+
+class ReverseChunkDecoder(object):
+    '''Serve frames in reverse order a chunk at a time
+       
+       A chunk ends at the requested frame and, with a FrameIndex, starts at
+       the earliest keyframe that still lets it fit into a buffer, so it
+       holds as many whole GOPs as fit (or many frames of an all-intra
+       video). It is decoded forward into one of two preallocated buffers,
+       which together take at most max_bytes. Only a GOP too long to fit
+       into a buffer gets decoded from its keyframe more than once.
+       Whenever a new chunk is taken, the one before it is prefetched into
+       the other buffer on a worker thread with its own VideoReader.
+       get is meant to be called from a single thread.'''
+    def __init__(self, video_file, index=None, max_bytes=512 * 2**20, **decode_options):
+        self.index = index
+        self.max_bytes = max_bytes
+        self.max_chunk = None # frames per buffer, from max_bytes and the frame size
+        self.reader = cv2_utils.VideoReader(video_file, index=index, **decode_options)
+        self.prefetch_reader = cv2_utils.VideoReader(video_file, index=index, **decode_options)
+        self.buffers = None # (2, max_chunk, H, W, C), allocated from the first frame
+        self.current = None
+        self._prefetch_thread = None
+        self._prefetched = None
+        self._cancel_prefetch = threading.Event()
+
+    def chunk_start(self, end):
+        lowest = max(end - self.max_chunk + 1, 0)
+        if self.index is None:
+            return lowest
+        keyframe = self.index.keyframe_after(lowest - 1) # the first one >= lowest
+        if keyframe <= end:
+            return keyframe
+        return max(lowest, self.index.keyframe_before(end)) # a GOP longer than a buffer
+
+    def _decode(self, reader, end, buffer_id, cancel=None):
+        '''Decode [chunk_start(end), end] into a buffer (None if nothing could be read)'''
+        start = self.chunk_start(end)
+        buffer = self.buffers[buffer_id]
+        n = 0
+        ret, _ = reader.read(start, out=buffer[0])
+        while ret:
+            n += 1
+            if n > end - start or (cancel is not None and cancel.is_set()):
+                break
+            ret, _ = reader.read(out=buffer[n])
+        return _Chunk(start, buffer[:n], buffer_id) if n else None
+
+    def _prefetch_worker(self, end, buffer_id):
+        self._prefetched = self._decode(self.prefetch_reader, end, buffer_id,
+                                        self._cancel_prefetch)
+
+    def _start_prefetch(self, end, buffer_id):
+        self._prefetched = None
+        self._cancel_prefetch.clear()
+        if end < 0:
+            return
+        self._prefetch_thread = threading.Thread(target=self._prefetch_worker,
+                                                 args=(end, buffer_id))
+        self._prefetch_thread.daemon = True
+        self._prefetch_thread.start()
+
+    def _finish_prefetch(self, cancel=False):
+        '''Wait for the worker (stopping it early if cancel) and get its chunk'''
+        if self._prefetch_thread is None:
+            return None
+        if cancel:
+            self._cancel_prefetch.set()
+        self._prefetch_thread.join()
+        self._prefetch_thread = None
+        return None if cancel else self._prefetched
+
+    def get(self, frame_number):
+        '''Get a frame (a view into a chunk buffer, valid until the chunk
+           after the next one is decoded), or None if it can't be read'''
+        current = self.current
+        if current is not None and current.start <= frame_number <= current.end:
+            return current.frames[frame_number - current.start]
+        if self.buffers is None:
+            ret, first = self.reader.read(frame_number)
+            if not ret:
+                return None
+            self.max_chunk = max(int(self.max_bytes // (2 * first.nbytes)), 1)
+            self.buffers = np.empty((2, self.max_chunk) + first.shape, dtype=first.dtype)
+        
+        # The next chunk back is usually the one being prefetched
+        expected = (current is not None and
+                    self.chunk_start(current.start - 1) <= frame_number < current.start)
+        chunk = self._finish_prefetch(cancel=not expected)
+        if chunk is None or not chunk.start <= frame_number <= chunk.end:
+            buffer_id = 0 if current is None else 1 - current.buffer_id
+            chunk = self._decode(self.reader, frame_number, buffer_id)
+            if chunk is None:
+                self.current = None
+                return None
+        self.current = chunk
+        self._start_prefetch(chunk.start - 1, 1 - chunk.buffer_id)
+        return chunk.frames[frame_number - chunk.start]
+
+    def close(self):
+        self._finish_prefetch(cancel=True)
+        self.current = None
+        self.reader.release()
+        self.prefetch_reader.release()
+
+class DecodeAheadThread(threading.Thread):
+    '''Keep a FrameRingBuffer full of the frames coming up next
+
+       Uses its own VideoReader so decoding never contends with the
+       reader the GUI uses for single frames (decode_options are passed
+       on to it, see cv2_utils.VideoReader).
+       retarget moves the decoder to a new position/direction and pause
+       stops it; neither restarts the thread.
+       Playing backwards (step -1) uses a ReverseChunkDecoder, created the
+       first time it's needed.'''
+    def __init__(self, video_file, num_frames=None, index=None, capacity=16,
+                 **decode_options):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.video_file = video_file
+        self.index = index
+        self.decode_options = decode_options
+        self.reverse_decoder = None
+        self.reader = cv2_utils.VideoReader(video_file, index=index, **decode_options)
+        self.num_frames = (num_frames if num_frames is not None else
+                           cv2_utils.count_frames(self.reader))
+        self.buffer = FrameRingBuffer(capacity)
+        self.control = threading.Condition()
+        self.next_frame = None # None while paused
+        self.step = 1
+        self.play_head = None
+        self.closed = False
+
+    def set_index(self, index):
+        '''Use a FrameIndex from now on (e.g. once it has been built)'''
+        with self.control:
+            self.index = index
+            self.reader.set_index(index)
+
+    def retarget(self, frame_number, step=1):
+        '''Start decoding from frame_number in direction step (+1 or -1)'''
+        with self.control:
+            self.buffer.clear()
+            self.next_frame = int(frame_number)
+            self.play_head = self.next_frame
+            self.step = step
+            self.control.notify_all()
+
+    def pause(self):
+        with self.control:
+            self.next_frame = None
+            self.buffer.clear()
+            self.buffer.release()
+
+    def close(self):
+        with self.control:
+            self.closed = True
+            self.next_frame = None
+            self.buffer.clear()
+            self.buffer.release()
+            self.control.notify_all()
+
+    def get_frame(self, frame_number, timeout=1.0):
+        '''Get a decoded frame (a view that is valid until the next call)
+           If the decoder isn't heading for frame_number, it gets retargeted'''
+        with self.control:
+            self.play_head = frame_number
+            # i.e. it is no further back than the last frame handed to the
+            # decoder (which may still be decoding, so it isn't buffered yet)
+            heading_for_it = (self.next_frame is not None and
+                              self.step * (frame_number - self.next_frame + self.step) >= 0)
+        if not heading_for_it and self.buffer.count == 0:
+            self.retarget(frame_number, self.step)
+        frame = self.buffer.get(frame_number, self.step, timeout=timeout)
+        if frame is None: # the decoder skipped past it (or stalled)
+            self.retarget(frame_number, self.step)
+            frame = self.buffer.get(frame_number, self.step, timeout=timeout)
+        return frame
+
+    def _next_job(self):
+        '''Wait until there is a frame to decode,
+           return (frame_number, step, generation)'''
+        with self.control:
+            while not self.closed and (self.next_frame is None or
+                                       not 0 <= self.next_frame < self.num_frames):
+                self.control.wait()
+            if self.closed:
+                return None, None, None
+            # Don't decode frames the play head has already passed
+            if (self.play_head is not None and
+                self.step * (self.play_head - self.next_frame) > 0):
+                self.next_frame = self.play_head
+            frame_number = self.next_frame
+            self.next_frame += self.step
+            return frame_number, self.step, self.buffer.generation
+
+    def _decode_reverse(self, frame_number, generation):
+        '''Copy a frame from the reverse chunk decoder into the ring'''
+        if self.reverse_decoder is not None and self.reverse_decoder.index is not self.index:
+            self.reverse_decoder.close() # made before the index was ready
+            self.reverse_decoder = None
+        if self.reverse_decoder is None:
+            self.reverse_decoder = ReverseChunkDecoder(self.video_file, index=self.index,
+                                                       **self.decode_options)
+        frame = self.reverse_decoder.get(frame_number)
+        if frame is None:
+            return
+        self.buffer.allocate(frame.shape, frame.dtype)
+        slot, _ = self.buffer.reserve()
+        if self.buffer.generation != generation:
+            return
+        self.buffer.frames[slot] = frame
+        self.buffer.commit(slot, generation, frame_number)
+
+    def run(self):
+        while True:
+            frame_number, step, generation = self._next_job()
+            if frame_number is None:
+                break
+            if step < 0:
+                self._decode_reverse(frame_number, generation)
+                continue
+            first_frame = None
+            if self.buffer.frames is None: # learn the frame shape
+                ret, first_frame = self.reader.read(frame_number)
+                if not ret:
+                    continue
+                self.buffer.allocate(first_frame.shape, first_frame.dtype)
+            slot, _ = self.buffer.reserve()
+            if self.buffer.generation != generation:
+                continue
+            if first_frame is None:
+                ret, _ = self.reader.read(frame_number, out=self.buffer.frames[slot])
+            else:
+                self.buffer.frames[slot] = first_frame
+            if ret:
+                self.buffer.commit(slot, generation, frame_number)
+        self.reader.release()
+        if self.reverse_decoder is not None:
+            self.reverse_decoder.close()
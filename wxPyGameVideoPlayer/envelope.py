@@ -0,0 +1,127 @@
+'''A multi-resolution min/max envelope (pyramid) of an audio track
+
+Level 0 holds the min and max of every base_bin samples, and each level
+above it combines factor bins of the one below. To plot a time range
+only the level with about one bin per screen pixel is needed, so a zoom
+or pan costs the same whether the file is one minute or ten hours long.
+
+The pyramid is built once from the streamed audio (see audio.py) and
+saved next to the video.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+
+import numpy as np
+
+from .cache_utils import sidecar_filename, file_signature, replace_file
+
+ENVELOPE_VERSION = 1
+
+def _reduce(mins, maxs, factor):
+    '''Combine every factor bins (padding the end with the last bin)'''
+    n_pad = -len(mins) % factor
+    if n_pad:
+        mins = np.concatenate([mins, mins[-1:].repeat(n_pad, axis=0)])
+        maxs = np.concatenate([maxs, maxs[-1:].repeat(n_pad, axis=0)])
+    shape = (-1, factor) + mins.shape[1:]
+    return mins.reshape(shape).min(axis=1), maxs.reshape(shape).max(axis=1)
+
+class EnvelopePyramid(object):
+    def __init__(self, levels, sample_rate, base_bin=256, factor=4):
+        self.levels = levels # list of (mins, maxs), each (n_bins, n_channels)
+        self.sample_rate = sample_rate
+        self.base_bin = base_bin
+        self.factor = factor
+
+    def bin_seconds(self, level):
+        return self.base_bin * self.factor**level / self.sample_rate
+
+    @classmethod
+    def from_chunks(cls, chunks, sample_rate, base_bin=256, factor=4):
+        '''Build from an iterable of (n_samples, n_channels) arrays,
+           keeping only one chunk of raw samples in memory at a time'''
+        mins, maxs = [], []
+        carry = None
+        for chunk in chunks:
+            data = chunk if carry is None else np.concatenate([carry, chunk])
+            n_full = len(data) // base_bin * base_bin
+            blocks = data[:n_full].reshape((-1, base_bin) + data.shape[1:])
+            mins.append(blocks.min(axis=1))
+            maxs.append(blocks.max(axis=1))
+            carry = data[n_full:]
+        if carry is not None and len(carry):
+            mins.append(carry.min(axis=0, keepdims=True))
+            maxs.append(carry.max(axis=0, keepdims=True))
+        if not mins:
+            raise ValueError('No samples to build an envelope from')
+        levels = [(np.concatenate(mins), np.concatenate(maxs))]
+        while len(levels[-1][0]) > 1:
+            levels.append(_reduce(levels[-1][0], levels[-1][1], factor))
+        return cls(levels, sample_rate, base_bin, factor)
+
+    def query(self, t0, t1, n_points):
+        '''Get (times, mins, maxs) covering [t0, t1] (in seconds) with at
+           least n_points bins where possible, using the coarsest level that
+           gives that; channels are combined into one envelope'''
+        t0, t1 = max(t0, 0), max(t1, 0)
+        level = 0
+        while (level + 1 < len(self.levels) and
+               (t1 - t0) / self.bin_seconds(level + 1) >= n_points):
+            level += 1
+        mins, maxs = self.levels[level]
+        bin_seconds = self.bin_seconds(level)
+        i0 = int(np.clip(np.floor(t0 / bin_seconds), 0, len(mins)))
+        i1 = int(np.clip(np.ceil(t1 / bin_seconds) + 1, 0, len(mins)))
+        times = np.arange(i0, i1) * bin_seconds
+        lo, hi = mins[i0:i1], maxs[i0:i1]
+        if lo.ndim > 1:
+            lo, hi = lo.min(axis=1), hi.max(axis=1)
+        return times, lo, hi
+
+    def save(self, filename, signature):
+        arrays = dict(version=ENVELOPE_VERSION, signature=np.array(signature, dtype=np.float64),
+                      params=np.array([self.sample_rate, self.base_bin, self.factor]))
+        for i, (mins, maxs) in enumerate(self.levels):
+            arrays['mins_{}'.format(i)] = mins
+            arrays['maxs_{}'.format(i)] = maxs
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as fid:
+            np.savez(fid, **arrays)
+        replace_file(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, signature):
+        '''Load a saved pyramid, or return None if it is missing or stale'''
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename) as saved:
+                if (int(saved['version']) != ENVELOPE_VERSION or
+                    tuple(saved['signature']) != tuple(np.array(signature, dtype=np.float64))):
+                    return None
+                sample_rate, base_bin, factor = saved['params']
+                n_levels = sum(1 for k in saved.files if k.startswith('mins_'))
+                levels = [(saved['mins_{}'.format(i)], saved['maxs_{}'.format(i)])
+                          for i in range(n_levels)]
+                return cls(levels, sample_rate, int(base_bin), int(factor))
+        except (IOError, ValueError, KeyError):
+            return None
+
+def get_audio_envelope(audio_stream, rebuild=False, save=True):
+    '''Load the sidecar envelope pyramid for an audio.AudioStream,
+       building (and saving) it if needed'''
+    video_file = audio_stream.video_file
+    envelope_file = sidecar_filename(video_file, 'audio_envelope', '.npz')
+    signature = file_signature(video_file)
+    envelope = None if rebuild else EnvelopePyramid.load(envelope_file, signature)
+    if envelope is None:
+        chunks = (chunk for _, chunk in audio_stream.iter_chunks(frames_per_chunk=300))
+        envelope = EnvelopePyramid.from_chunks(chunks, audio_stream.sample_rate)
+        if save:
+            try:
+                envelope.save(envelope_file, signature)
+            except (IOError, OSError):
+                pass
+    return envelope
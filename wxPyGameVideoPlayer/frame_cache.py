@@ -0,0 +1,116 @@
+'''An LRU cache of decoded frames with a memory budget
+
+Stepping back and forth over the same few frames (or building thumbnails
+of frames that were just displayed) shouldn't decode them again.
+Frames are keyed by (file, frame number, output format) so the display,
+matplotlib and the thumbnail helpers can all share one cache.'''
+
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+from . import cv2_utils
+
+DEFAULT_MAX_BYTES = 512 * 2**20
+
+class FrameCache(object):
+    '''Least-recently-used frame cache limited to max_bytes
+
+       Cached frames are made read-only since they are shared.
+       hits, misses and evictions count cache activity (see stats)
+       to help size the budget.'''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._frames = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def get(self, key):
+        '''Get a cached frame (or None), marking it as recently used'''
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._frames[key] = self._frames.pop(key) # move to the end
+            return frame
+
+    def put(self, key, frame):
+        '''Add a frame, evicting the least recently used ones to fit the budget'''
+        if frame is None or frame.nbytes > self.max_bytes:
+            return frame
+        frame.flags.writeable = False
+        with self._lock:
+            if key in self._frames:
+                self.n_bytes -= self._frames.pop(key).nbytes
+            self._frames[key] = frame
+            self.n_bytes += frame.nbytes
+            self._evict()
+        return frame
+
+    def _evict(self):
+        while self.n_bytes > self.max_bytes and self._frames:
+            _, frame = self._frames.popitem(last=False)
+            self.n_bytes -= frame.nbytes
+            self.evictions += 1
+
+    def nearest(self, filename, frame_number, format_key='bgr'):
+        '''The cached frame of a file closest to frame_number, as
+           (frame_number, frame), or (None, None) if there is none
+           (e.g. to show something right away while the exact frame decodes)
+           Doesn't count as a hit or miss or change the LRU order'''
+        best, best_key = None, None
+        with self._lock:
+            for key in self._frames:
+                if key[0] == filename and key[2] == format_key:
+                    distance = abs(key[1] - frame_number)
+                    if best is None or distance < best:
+                        best, best_key = distance, key
+            if best_key is None:
+                return None, None
+            return best_key[1], self._frames[best_key]
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get_or_load(self, key, loader):
+        '''Get a cached frame or call loader() to get it (and cache it)'''
+        frame = self.get(key)
+        return self.put(key, loader()) if frame is None else frame
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.n_bytes = 0
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    n_frames=len(self._frames), n_bytes=self.n_bytes,
+                    max_bytes=self.max_bytes)
+
+default_cache = FrameCache()
+
+def get_frame(video_file, frame_number, cache=None):
+    '''Get a frame from a video file (BGR) or VideoReader (in the reader's
+       output format) through the cache
+       Returns None if the frame can't be read'''
+    cache = default_cache if cache is None else cache
+    filename = getattr(video_file, 'video_file', video_file)
+    key = (filename, int(frame_number), getattr(video_file, 'format_key', 'bgr'))
+    return cache.get_or_load(key, lambda: cv2_utils.get_opencv_frame(video_file, frame_number)[1])
@@ -0,0 +1,116 @@
+'''Exact per-frame timestamps and keyframes for accurate seeking
+
+Seeking straight to a frame lands wherever the backend decides. With an
+index, a seek goes to the nearest preceding keyframe (where seeking is
+exact) and decodes forward to the requested frame, so any frame costs at
+most one GOP of decoding. The timestamps also give the time of every
+frame, including on variable frame rate files.
+
+The index is built with a single pass over the compressed packets (no
+decoding) and saved next to the video so later opens skip the scan.'''
+
+from __future__ import absolute_import
+
+import os
+
+import numpy as np
+import cv2
+
+from .cache_utils import sidecar_filename, file_signature, replace_file
+
+INDEX_VERSION = 1
+
+class FrameIndex(object):
+    '''Presentation time (ms) of every frame and the sorted keyframe numbers'''
+    def __init__(self, pts_msec, keyframes):
+        self.pts_msec = np.asarray(pts_msec, dtype=np.float64)
+        self.keyframes = np.asarray(keyframes, dtype=np.int64)
+    
+    def __len__(self):
+        return len(self.pts_msec)
+    
+    def keyframe_before(self, frame_number):
+        '''The last keyframe at or before frame_number'''
+        i = np.searchsorted(self.keyframes, frame_number, side='right') - 1
+        return int(self.keyframes[max(i, 0)])
+    
+    def keyframe_after(self, frame_number):
+        '''The first keyframe after frame_number (or the frame count)'''
+        i = np.searchsorted(self.keyframes, frame_number, side='right')
+        return (int(self.keyframes[i]) if i < len(self.keyframes) else
+                len(self))
+    
+    def frame_to_msec(self, frame_number):
+        return self.pts_msec[frame_number]
+    
+    def msec_to_frame(self, msec):
+        '''The frame being displayed at time msec'''
+        i = np.searchsorted(self.pts_msec, msec, side='right') - 1
+        return np.clip(i, 0, len(self) - 1)
+    
+    def save(self, filename, signature):
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as fid:
+            np.savez(fid, pts_msec=self.pts_msec, keyframes=self.keyframes,
+                     signature=np.array(signature, dtype=np.float64),
+                     version=INDEX_VERSION)
+        replace_file(temp_filename, filename)
+    
+    @classmethod
+    def load(cls, filename, signature):
+        '''Load a saved index, or return None if it is missing or stale'''
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename) as saved:
+                if (int(saved['version']) != INDEX_VERSION or
+                    tuple(saved['signature']) != tuple(np.array(signature, dtype=np.float64))):
+                    return None
+                return cls(saved['pts_msec'], saved['keyframes'])
+        except (IOError, ValueError, KeyError):
+            return None
+    
+    @classmethod
+    def build(cls, video_file):
+        '''Scan the video once, recording each frame's timestamp and
+           whether it is a keyframe
+           
+           This reads raw packets (CAP_PROP_FORMAT=-1) so nothing is decoded.
+           If the backend can't do that, every frame is decoded and treated
+           as its own keyframe, i.e. seeking falls back to the backend's
+           own (frame number based) accuracy'''
+        pts, is_key = [], []
+        raw = hasattr(cv2, 'CAP_PROP_LRF_HAS_KEY_FRAME')
+        cap = (cv2.VideoCapture(video_file, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+               if raw else None)
+        if cap is None or not cap.isOpened():
+            raw = False
+            cap = cv2.VideoCapture(video_file)
+        while cap.grab():
+            pts.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+            is_key.append(cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME) if raw else 1)
+        cap.release()
+        
+        # Packets come in decode order; frame numbers follow presentation order
+        pts, is_key = np.array(pts, dtype=np.float64), np.array(is_key, dtype=bool)
+        order = np.argsort(pts, kind='mergesort')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        keyframes = np.sort(rank[is_key])
+        if len(keyframes) == 0 or keyframes[0] != 0:
+            keyframes = np.concatenate([[0], keyframes]) # always allow seeking to the start
+        return cls(pts[order], keyframes)
+
+def get_frame_index(video_file, rebuild=False, save=True):
+    '''Load the sidecar index for a video, building (and saving) it if needed'''
+    index_file = sidecar_filename(video_file, 'frame_index', '.npz')
+    signature = file_signature(video_file)
+    index = None if rebuild else FrameIndex.load(index_file, signature)
+    if index is None:
+        index = FrameIndex.build(video_file)
+        if save:
+            try:
+                index.save(index_file, signature)
+            except (IOError, OSError):
+                pass # an unwritable cache just means rebuilding next time
+    return index
@@ -0,0 +1,158 @@
+'''Decode a short clip once into a memory mapped (N, H, W, 3) uint8 file
+
+For short clips reviewed frame by frame, decoding the compressed video
+again for every step is wasted work. A FrameStoreBuilder streams every
+frame into a .npy file on the local disk (see
+cache_utils.local_cache_filename) in a background thread; after that,
+getting a frame is just a slice of the memory map (a page cache lookup).
+
+A manifest next to the store records the video's fingerprint, so the
+store is reused across sessions until the video changes.
+Only clips whose decoded size is under a threshold get a store.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import re
+import json
+import shutil
+import threading
+
+import numpy as np
+
+from . import cv2_utils
+from .cache_utils import local_cache_filename, file_fingerprint, replace_file
+from .playback_clock import now
+
+FRAME_STORE_VERSION = 1
+DEFAULT_MAX_BYTES = 2 * 2**30
+
+def frame_store_filename(video_file, format_key='bgr'):
+    return local_cache_filename(video_file, 'frames_' + re.sub(r'\W+', '_', format_key), '.npy')
+
+def fits(num_frames, frame_shape, max_bytes=DEFAULT_MAX_BYTES, directory=None):
+    '''Whether a store for this clip is under max_bytes (and fits on the disk)'''
+    n_bytes = num_frames * int(np.prod(frame_shape))
+    if n_bytes > max_bytes:
+        return False
+    disk_usage = getattr(shutil, 'disk_usage', None) # Python 3.3+
+    if directory is not None and disk_usage is not None:
+        return n_bytes < 0.9 * disk_usage(directory).free
+    return True
+
+class FrameStore(object):
+    '''Random access to the frames of a store (frames [0, n_ready) are valid)'''
+    def __init__(self, frames, n_ready):
+        self.frames = frames
+        self.n_ready = n_ready
+
+    def __len__(self):
+        return self.n_ready
+
+    def get(self, frame_number):
+        '''A frame (a view into the memory map) or None if it isn't stored (yet)'''
+        if 0 <= frame_number < self.n_ready:
+            return self.frames[frame_number]
+        return None
+
+    @classmethod
+    def load(cls, video_file, format_key='bgr', fingerprint=None):
+        '''Open a finished store read-only, or return None if there is no
+           store or it was built from a different version of the video'''
+        filename = frame_store_filename(video_file, format_key)
+        try:
+            with open(filename + '.json') as fid:
+                manifest = json.load(fid)
+            fingerprint = file_fingerprint(video_file) if fingerprint is None else fingerprint
+            if (manifest.get('version') != FRAME_STORE_VERSION or
+                manifest.get('fingerprint') != fingerprint):
+                return None
+            return cls(np.load(filename, mmap_mode='r'), manifest['n_ready'])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+class FrameStoreBuilder(threading.Thread):
+    '''Decode a whole video into a FrameStore in a background thread
+
+       store can already be used while building (for the frames decoded
+       so far), progress is the fraction done and done is set at the end
+       (with error set if it failed). progress_callback(n_done, n_total)
+       is called from the worker at most every callback_interval seconds
+       and once at the end. decode_options go to the VideoReader.'''
+    def __init__(self, video_file, num_frames, index=None, progress_callback=None,
+                 callback_interval=0.5, **decode_options):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.video_file = video_file
+        self.num_frames = num_frames
+        self.index = index
+        self.progress_callback = progress_callback
+        self.callback_interval = callback_interval
+        self.decode_options = decode_options
+        self.store = None
+        self.error = None
+        self.done = False
+        self._cancel = threading.Event()
+
+    @property
+    def progress(self):
+        return 0. if self.store is None else self.store.n_ready / max(self.num_frames, 1)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        try:
+            self._build()
+        except Exception as e: # anything, so done is always set
+            self.error = str(e) or type(e).__name__
+        finally:
+            self.done = True
+            if self.progress_callback is not None:
+                self.progress_callback(0 if self.store is None else self.store.n_ready,
+                                       self.num_frames)
+
+    def _build(self):
+        fingerprint = file_fingerprint(self.video_file)
+        temp_filename = frames = None
+        try:
+            with cv2_utils.VideoReader(self.video_file, index=self.index,
+                                       **self.decode_options) as reader:
+                filename = frame_store_filename(self.video_file, reader.format_key)
+                ret, first = reader.read(0)
+                if not ret:
+                    raise IOError('Could not read frames from {}'.format(self.video_file))
+                temp_filename = filename + '.partial'
+                frames = np.lib.format.open_memmap(temp_filename, mode='w+', dtype=first.dtype,
+                                                   shape=(self.num_frames,) + first.shape)
+                frames[0] = first
+                self.store = FrameStore(frames, 1)
+                last_callback = now()
+                for i in range(1, self.num_frames):
+                    if self._cancel.is_set():
+                        break
+                    ret, _ = reader.read(out=frames[i])
+                    if not ret:
+                        break
+                    self.store.n_ready = i + 1
+                    if (self.progress_callback is not None and
+                        now() - last_callback > self.callback_interval):
+                        self.progress_callback(i + 1, self.num_frames)
+                        last_callback = now()
+            frames.flush()
+            if self._cancel.is_set():
+                return
+            n_ready = self.store.n_ready
+            replace_file(temp_filename, filename)
+            temp_filename = None # kept
+            with open(filename + '.json.tmp', 'w') as fid:
+                json.dump(dict(version=FRAME_STORE_VERSION, fingerprint=fingerprint,
+                               n_ready=n_ready), fid)
+            replace_file(filename + '.json.tmp', filename + '.json')
+            self.store = FrameStore(np.load(filename, mmap_mode='r'), n_ready) # read-only from now on
+        finally:
+            if temp_filename is not None: # cancelled or failed: drop the partial store
+                self.store = frames = None # unmap it first (needed on Windows)
+                if os.path.exists(temp_filename):
+                    os.remove(temp_filename)
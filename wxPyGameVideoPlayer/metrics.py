@@ -0,0 +1,230 @@
+'''Per-frame metrics (traces) computed in one streaming pass over a video
+
+A metric is a function that takes a batch of frames (N, H, W, 3) and
+returns N values, so the work is vectorized across the whole batch.
+Metrics that compare neighbouring frames also get the last frame of the
+previous batch (None for the first batch).
+
+Register new metrics with the register_metric decorator; METRICS keeps
+them in registration order (this is also the order of the checkboxes).
+
+Finished traces are kept in a MetricsCache next to the video, one .npy
+file per metric, so reopening a file only computes metrics that are
+new or whose version changed.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import cv2_utils
+from .cache_utils import sidecar_filename, file_fingerprint, replace_file
+
+METRICS = OrderedDict()
+
+class Metric(object):
+    __slots__ = ('name', 'func', 'version', 'needs_previous')
+    def __init__(self, name, func, version=1, needs_previous=False):
+        self.name = name
+        self.func = func
+        self.version = version
+        self.needs_previous = needs_previous
+
+def register_metric(name, version=1, needs_previous=False):
+    '''Decorator to add a metric, func(frames, previous) -> (N,) values
+       Bump version whenever the function's output changes'''
+    def wrap(func):
+        METRICS[name] = Metric(name, func, version, needs_previous)
+        return func
+    return wrap
+
+def _gray(frames):
+    '''Luma (ITU-R 601) of a batch of BGR frames as float32'''
+    weights = np.array([0.114, 0.587, 0.299], dtype=np.float32)
+    return frames.astype(np.float32).dot(weights)
+
+def _with_previous(frames, previous):
+    '''Frames preceded by the previous batch's last frame (or a copy of the first)'''
+    first = frames[:1] if previous is None else previous[None]
+    return np.concatenate([first, frames])
+
+@register_metric('mean brightness')
+def mean_brightness(frames, previous=None):
+    return frames.reshape(len(frames), -1).mean(axis=1)
+
+@register_metric('frame difference', needs_previous=True)
+def frame_difference(frames, previous=None):
+    '''Mean absolute difference from the previous frame'''
+    stack = _with_previous(frames, previous).astype(np.int16)
+    return np.abs(np.diff(stack, axis=0)).reshape(len(frames), -1).mean(axis=1)
+
+@register_metric('motion energy', needs_previous=True)
+def motion_energy(frames, previous=None, threshold=16):
+    '''Fraction of pixels whose brightness changed by more than threshold'''
+    gray = _gray(_with_previous(frames, previous))
+    moving = np.abs(np.diff(gray, axis=0)) > threshold
+    return moving.reshape(len(frames), -1).mean(axis=1)
+
+@register_metric('histogram entropy')
+def histogram_entropy(frames, previous=None, n_bins=64):
+    '''Entropy (bits) of each frame's brightness histogram'''
+    bins = (_gray(frames) * (n_bins / 256.)).astype(np.int64).reshape(len(frames), -1)
+    offsets = (np.arange(len(frames)) * n_bins)[:, None]
+    counts = np.bincount((bins + offsets).ravel(),
+                         minlength=len(frames) * n_bins).reshape(len(frames), n_bins)
+    p = counts / counts.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.nansum(p * np.log2(p), axis=1)
+
+class MetricsCache(object):
+    '''Computed traces stored in a directory next to the video
+
+       Each metric is its own .npy file (memory mapped on load), and a
+       manifest records the video's fingerprint and each metric's version;
+       entries are only used if both still match'''
+    def __init__(self, video_file):
+        self.video_file = video_file
+        self.directory = sidecar_filename(video_file, 'metrics', '')
+        self.fingerprint = file_fingerprint(video_file)
+        self.lock = threading.Lock()
+
+    def _manifest_file(self):
+        return os.path.join(self.directory, 'manifest.json')
+
+    def _metric_file(self, name):
+        return os.path.join(self.directory, re.sub(r'\W+', '_', name) + '.npy')
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_file()) as fid:
+                manifest = json.load(fid)
+        except (IOError, OSError, ValueError):
+            manifest = None
+        if manifest is None or manifest.get('fingerprint') != self.fingerprint:
+            manifest = {'fingerprint': self.fingerprint, 'versions': {}}
+        return manifest
+
+    def load(self, name, num_frames=None):
+        '''The cached trace for a metric (memory mapped), or None if it is
+           missing or stale'''
+        version = self._read_manifest()['versions'].get(name)
+        if version != METRICS[name].version:
+            return None
+        try:
+            values = np.load(self._metric_file(name), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        if num_frames is not None and len(values) != num_frames:
+            return None
+        return values
+
+    def save(self, name, values):
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            manifest = self._read_manifest()
+            metric_file = self._metric_file(name)
+            with open(metric_file + '.tmp', 'wb') as fid:
+                np.save(fid, np.asarray(values))
+            replace_file(metric_file + '.tmp', metric_file)
+            manifest['versions'][name] = METRICS[name].version
+            with open(self._manifest_file() + '.tmp', 'w') as fid:
+                json.dump(manifest, fid)
+            replace_file(self._manifest_file() + '.tmp', self._manifest_file())
+
+class MetricsComputation(threading.Thread):
+    '''Compute metrics for every frame in a background thread
+
+       results maps each metric name to a float array (one value per frame,
+       NaN until computed), so partial traces can be plotted at any time.
+       callback(n_done) is called from the worker thread at most every
+       callback_interval seconds and once at the end; cancel() stops early.
+       Frames are decoded downscaled since the metrics don't need detail.
+       If a MetricsCache is given, the results are saved to it, but only
+       if the pass covered every frame (see complete).'''
+    def __init__(self, video_file, metric_names, num_frames, batch_size=32,
+                 downscale=2, index=None, callback=None, callback_interval=0.5,
+                 cache=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.video_file = video_file
+        self.metrics = [METRICS[name] for name in metric_names]
+        self.num_frames = num_frames
+        self.batch_size = batch_size
+        self.downscale = downscale
+        self.index = index
+        self.callback = callback
+        self.callback_interval = callback_interval
+        self.cache = cache
+        self.results = OrderedDict((name, np.full(num_frames, np.nan))
+                                   for name in metric_names)
+        self.n_done = 0
+        self.finished = False # set (before the last callback) once the pass is over
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def complete(self):
+        '''Whether every frame was computed (not cancelled or cut short by a failed read)'''
+        return self.n_done >= self.num_frames and not self.cancelled
+
+    def run(self):
+        try:
+            self._compute()
+            if self.cache is not None and self.complete:
+                for name, values in self.results.items():
+                    try:
+                        self.cache.save(name, values)
+                    except (IOError, OSError):
+                        pass
+        finally:
+            self.finished = True
+            if self.callback is not None:
+                self.callback(self.n_done)
+
+    def _compute(self):
+        if not self.metrics:
+            return
+        with cv2_utils.VideoReader(self.video_file, index=self.index,
+                                   downscale=self.downscale) as reader:
+            ret, frame = reader.read(0)
+            if not ret:
+                return
+            batch = np.empty((self.batch_size,) + frame.shape, dtype=frame.dtype)
+            batch[0] = frame
+            n_batch = 1
+            previous = None
+            last_callback = time.time()
+            while not self.cancelled:
+                while n_batch < self.batch_size and self.n_done + n_batch < self.num_frames:
+                    ret, _ = reader.read(out=batch[n_batch])
+                    if not ret:
+                        break
+                    n_batch += 1
+                if n_batch == 0:
+                    break
+                frames = batch[:n_batch]
+                start = self.n_done
+                for metric in self.metrics:
+                    self.results[metric.name][start:start + n_batch] = metric.func(frames, previous)
+                previous = frames[-1].copy()
+                self.n_done += n_batch
+                if self.callback is not None and time.time() - last_callback > self.callback_interval:
+                    self.callback(self.n_done)
+                    last_callback = time.time()
+                if n_batch < self.batch_size: # end of the stream
+                    break
+                n_batch = 0
@@ -12,7 +12,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import os
-import time
+import threading
+import subprocess
 import numpy as np
 import wx
 import matplotlib
@@ -21,17 +22,50 @@ matplotlib.interactive(False)
 import matplotlib.pyplot as plt
 
 from .wx_video_ui import VideoPlayerFrame
+from . import audio
 from . import cv2_utils
+from . import decode_ahead
+from . import envelope
+from . import frame_cache
+from . import frame_index
+from . import frame_store
+from . import metrics
+from . import perf
+from . import proxy
 from . import pygame_interface
+from . import renderers
+from . import scene_cuts
+from . import seek_service
 
 from mpl_utils import plotting_decorator, plot_or_update
 
 class OpenCVDataInterface(object):
     gui_app = None
     filename = None
+    reader = None
+    decoder = None
+    proxy_builder = None
+    proxy_decoder = None
+    decode_once_store = None # decode-once memory map of the whole clip (if enabled)
+    decode_once_builder = None
+    display_size = None
+    audio_stream = None
+    audio_envelope = None
+    _audio_envelope_thread = None
+    _audio_artists = () # the envelope fill or raw sample lines
+    traces = None # metric name -> value per frame (complete traces only)
+    metrics_computation = None
+    metrics_cache = None
+    scene_cut_frames = None
+    _scene_cut_thread = None
+    _scene_cut_pending = None # called once the cuts are found (e.g. a jump)
     _video_frame_rate = None
     num_frames = None
     pygame_plot_object = None
+    _playing_file = None
+    _play_head = None # the frame number playback last reported or was sent to
+    _play_speed = None
+    _play_skip_frames = None
     pygame_thread = None
     mpl_image = None
     time_line = None
@@ -39,19 +73,32 @@ class OpenCVDataInterface(object):
     mpl_time_plots_fig = None
     mpl_image_fig = None
     _time_plot_click_connection = None
+    _time_plot_draw_connection = None
+    _time_background = None # the time plot without the cursor, for blitting
+    mpl_sink = None
     use_mpl = True
     use_pygame = True
-    _lock_finished_time = None # Ready to go: use -1 for totally locked
-                               #              use a timestamp for temporary locking
     
-    def __init__(self, gui_app, use_mpl=True, use_pygame=True):
+    def __init__(self, gui_app, use_mpl=True, use_pygame=True, cache=None):
         self.gui_app = gui_app
         self.use_mpl = use_mpl
         self.use_pygame = use_pygame
+        self.frame_cache = (frame_cache.default_cache if cache is None else
+                            cache) # shared with the thumbnail helpers by default
+        self.traces = {}
+        self.renderer = renderers.FrameRenderer() # sinks are added as they get linked
+        self.timings = perf.StageTimings() # filled in by every stage of playback
+        self.seek_service = seek_service.SeekService(self._load_seek, self._on_seek_ready)
+        self.seek_service.start()
     
     def link_pygame(self, pygame_plot_object, pygame_thread):
         self.pygame_plot_object = pygame_plot_object
         self.pygame_thread = pygame_thread
+        pygame_plot_object.timings = self.timings
+        pygame_thread.timings = self.timings
+        if self.use_pygame:
+            self.renderer.add_sink(renderers.PygameSink(
+                pygame_plot_object, get_size=lambda: self.display_size))
         
     def set_figures(self, mpl_static_plots_fig=None,
                           mpl_time_plots_fig=None,
@@ -66,14 +113,21 @@ class OpenCVDataInterface(object):
         self.mpl_image_fig = (None if not self.use_mpl else
                               plt.figure(3) if mpl_image_fig is None
                               else mpl_image_fig)
+        if self.use_mpl:
+            if self.mpl_sink is not None:
+                self.renderer.remove_sink(self.mpl_sink)
+            self.mpl_sink = self.renderer.add_sink(renderers.MplSink(
+                lambda rgb: self.mpl_imshow(rgb, figure=self.mpl_image_fig)))
 
         # Set the onclick event for the time plot so it changes video frames
         def onclick(event):
-            new_frame_number = event.xdata * self._video_frame_rate
-            self.gui_app.video_frame.set_frame_number(new_frame_number)
-            self.update()
+            if event.xdata is None: # outside the axes
+                return
+            new_frame_number = self.get_frame_at_time(event.xdata)
+            self.gui_app.video_frame.set_frame_number(new_frame_number) # this calls update
 
         self._time_plot_click_connection = self.mpl_time_plots_fig.canvas.mpl_connect('button_press_event', onclick)
+        self._time_plot_draw_connection = self.mpl_time_plots_fig.canvas.mpl_connect('draw_event', self._on_time_plot_draw)
 
         plt.ioff()
     
@@ -84,61 +138,316 @@ class OpenCVDataInterface(object):
     @plotting_decorator(draw=True)
     def _update_vline(self, frame_num=None):
         x = self.get_frame_time(frame_num)
-        self.time_line = plot_or_update(self.time_line, plt.axvline, x, color='k')
+        self.time_line = plot_or_update(self.time_line, plt.axvline, x, color='k',
+                                        animated=True) # only drawn by blitting
     
     def update_vline(self, frame_num=None, rebuild=False):
-        if rebuild:
-            self.time_line = None
-        self._update_vline(frame_num=frame_num,
-                           figure=self.mpl_time_plots_fig)
+        '''Move the time cursor
+           Once the background has been captured (after a full draw), this
+           just restores it and blits the line instead of redrawing the plot'''
+        canvas = self.mpl_time_plots_fig.canvas
+        if (rebuild or self.time_line is None or self._time_background is None or
+            not getattr(canvas, 'supports_blit', False)):
+            if rebuild:
+                self.time_line = None
+            self._time_background = None # recaptured by the draw event
+            self._update_vline(frame_num=frame_num,
+                               figure=self.mpl_time_plots_fig)
+            return
+        x = self.get_frame_time(frame_num)
+        self.time_line.set_xdata([x, x])
+        canvas.restore_region(self._time_background)
+        self.time_line.axes.draw_artist(self.time_line)
+        canvas.blit(self.time_line.axes.bbox)
+    
+    def _on_time_plot_draw(self, event):
+        '''After every full draw (new traces, zoom, resize...), grab the new
+           background and put the (animated) cursor back on top'''
+        if self.time_line is None or self.time_line.axes is None:
+            return
+        ax = self.time_line.axes
+        self._time_background = self.mpl_time_plots_fig.canvas.copy_from_bbox(ax.bbox)
+        ax.draw_artist(self.time_line)
+    
+    def load_audio_envelope(self):
+        '''Start loading (building it the first time) the audio envelope
+           pyramid and the raw PCM cache in the background; the traces are
+           redrawn once they're ready
+           audio_envelope stays None if the file has no usable audio'''
+        if self._audio_envelope_thread is not None:
+            return
+        self._audio_envelope_thread = threading.Thread(target=self._build_audio_envelope,
+                                                       args=(self.filename,))
+        self._audio_envelope_thread.daemon = True
+        self._audio_envelope_thread.start()
+        self.gui_app.set_status('Reading the audio...')
+    
+    def _build_audio_envelope(self, filename):
+        audio_stream = audio_envelope = None
+        try:
+            audio_stream = audio.AudioStream(filename, self._video_frame_rate)
+            try:
+                audio_stream.build_cache() # raw samples for zooming in past the envelope
+            except (IOError, OSError, ValueError):
+                pass # the envelope alone will do
+            audio_envelope = envelope.get_audio_envelope(audio_stream) # from the cache if built
+        except (IOError, OSError, ValueError, subprocess.CalledProcessError):
+            audio_stream = None
+        finally:
+            wx.CallAfter(self._set_audio_envelope, filename, audio_stream, audio_envelope)
+    
+    def _set_audio_envelope(self, filename, audio_stream, audio_envelope):
+        if filename != self.filename:
+            return
+        self._audio_envelope_thread = None
+        self.audio_stream, self.audio_envelope = audio_stream, audio_envelope
+        self.gui_app.set_status(None)
+        self._update_traces(figure=self.mpl_time_plots_fig)
+    
+    def _draw_audio_envelope(self, ax):
+        '''Draw the audio envelope with about one point per pixel of the
+           visible time range (reruns whenever the x limits change)
+           Zoomed in further than the finest envelope level, the raw
+           samples are drawn instead (only from the PCM cache, so this
+           never waits on ffmpeg)'''
+        for artist in self._audio_artists:
+            artist.remove()
+        t0, t1 = ax.get_xlim()
+        n_points = int(ax.bbox.width)
+        scale = 1. / 32768 # int16 -> [-1, 1]
+        if (self.audio_stream.load_cache() is not None and
+            (t1 - t0) / self.audio_envelope.bin_seconds(0) < n_points):
+            sample_rate = self.audio_stream.sample_rate
+            start = int(max(t0, 0) * sample_rate)
+            samples = self.audio_stream.read_samples(start, int(max(t1, 0) * sample_rate) + 1)
+            t = (start + np.arange(len(samples))) / float(sample_rate)
+            self._audio_artists = ax.plot(t, scale * samples, color='0.7', linewidth=0.5)
+            return
+        t, lo, hi = self.audio_envelope.query(t0, t1, n_points)
+        self._audio_artists = [ax.fill_between(t, scale * lo, scale * hi, step='post',
+                                               color='0.7', linewidth=0)]
+    
+    def get_traces(self):
+        '''All traces so far, including partial ones still being computed'''
+        traces = dict(self.traces)
+        if self.metrics_computation is not None:
+            traces.update(self.metrics_computation.results)
+        return traces
+    
+    def compute_metrics(self, metric_names):
+        '''Load the metrics we don't have yet from the cache and start
+           computing (in the background) any that aren't cached
+           A pass that is already computing all of those keeps running;
+           the time plot is redrawn with the partial traces as they come in'''
+        if self.metrics_cache is None:
+            self.metrics_cache = metrics.MetricsCache(self.filename)
+        missing = []
+        for name in metric_names:
+            if name not in self.traces:
+                values = self.metrics_cache.load(name, self.num_frames)
+                if values is None:
+                    missing.append(name)
+                else:
+                    self.traces[name] = values
+        running = self.metrics_computation
+        if running is not None:
+            if set(missing) <= set(running.results): # don't throw its work away
+                return
+            running.cancel()
+            self.metrics_computation = None
+        if not missing:
+            return
+        computation = metrics.MetricsComputation(
+            self.filename, missing, self.num_frames, index=self.reader.index,
+            callback=lambda n_done: wx.CallAfter(self._on_metrics_progress, computation),
+            cache=self.metrics_cache)
+        self.metrics_computation = computation
+        computation.start()
+    
+    def _on_metrics_progress(self, computation):
+        if computation is not self.metrics_computation: # cancelled or replaced
+            return
+        if computation.finished:
+            if not computation.cancelled:
+                self.traces.update(computation.results)
+            self.metrics_computation = None
+        self._update_traces(figure=self.mpl_time_plots_fig)
     
     @plotting_decorator(draw=False, cla=True)
     def _update_traces(self):
         if self.filename:
-            time_axis = np.arange(self.num_frames) / self._video_frame_rate
-            plt.plot(time_axis, time_axis) # stand-in plot for real traces
+            time_axis = self.get_frame_time(np.arange(self.num_frames))
+            checked = self.gui_app.video_frame.get_checked_traces()
+            traces = self.get_traces()
+            for name in checked:
+                if name in traces and not np.all(np.isnan(traces[name])):
+                    values = traces[name]
+                    plt.plot(time_axis, values / (np.nanmax(np.abs(values)) or 1), # scaled to fit
+                             label=name)
+            self._audio_artists = () # removed by cla
+            if 'audio' in checked and self.audio_envelope is not None:
+                ax = plt.gca()
+                self._draw_audio_envelope(ax)
+                ax.callbacks.connect('xlim_changed', self._draw_audio_envelope)
+            if plt.gca().get_legend_handles_labels()[0]:
+                plt.legend(loc='upper right', fontsize='small')
         self.update_vline(rebuild=True) # rebuild this since we are running cla
                                         # also, this calls draw, so no need to do it twice
     
     def update_traces(self):
+        '''Plot the traces whose checkboxes are ticked, computing them if needed'''
+        checked = self.gui_app.video_frame.get_checked_traces()
+        if self.filename:
+            if 'audio' in checked and self.audio_envelope is None:
+                self.load_audio_envelope()
+            self.compute_metrics([name for name in checked if name in metrics.METRICS])
         self._update_traces(figure=self.mpl_time_plots_fig)
     
-    def plot_frame(self, frame_num, use_mpl=False):
-        self.frame_data = cv2_utils.get_opencv_frame_as_array(self.filename, frame_num)
-        
-        if use_mpl:
-            self.mpl_imshow(self.frame_data, figure=self.mpl_image_fig)
-        
-        if self.use_pygame:
-            self.pygame_plot_object.imshowT(self.frame_data)
-        
-        
+    def get_frame(self, frame_num):
+        '''Get a decoded (BGR) frame, from the frame store or cache if possible'''
+        frame = None if self.decode_once_store is None else self.decode_once_store.get(frame_num)
+        if frame is not None:
+            return frame
+        return frame_cache.get_frame(self.reader, frame_num, cache=self.frame_cache)
+    
+    def plot_frame(self, frame_num, force=False):
+        frame = self.get_frame(frame_num)
+        if frame is not None:
+            self.show_frame(frame_num, frame, force=force)
+    
+    def show_frame(self, frame_num, frame, force=False):
+        '''Show an already decoded (BGR) frame, e.g. from the decode-ahead thread
+           Each display (see renderers) takes frames at its own rate, unless
+           force is set (for a paused frame)'''
+        self.frame_data = frame[:, :, ::-1] # RGB view, no copy
+        self.renderer.submit(frame_num, frame, force=force)
 
     def update(self):
-        '''Called when switching frames or hitting pause'''
+        '''Called when switching frames or changing settings
+           During playback, this moves the play head and sets the speed
+           and frame skipping, sending only what changed'''
+        if self.is_playing():
+            frame_num = self.get_frame_number()
+            if frame_num != self._play_head: # moved by the user, not by playback
+                self._play_head = frame_num
+                self.pygame_thread.send(pygame_interface.Seek(frame_num))
+            video_frame = self.gui_app.video_frame
+            self._set_playback_rate(video_frame.get_playback_speed(),
+                                    video_frame.get_skip_frames())
+            return
+        self.show_current_frame()
+    
+    def show_current_frame(self):
+        '''Returns right away: a cached frame is shown immediately,
+           otherwise the nearest cached frame stands in while the seek
+           service decodes the exact one (only the latest request is kept)'''
         frame_num = self.get_frame_number()
-        self.plot_frame(frame_num, use_mpl=self.use_mpl)
-        self.update_vline()
+        self.update_vline(frame_num)
+        if self.reader is None:
+            return
+        frame = self.frame_cache.get((self.filename, frame_num, self.reader.format_key))
+        if frame is not None:
+            self.seek_service.cancel()
+            self.show_frame(frame_num, frame, force=True)
+            return
+        near_num, near_frame = self.frame_cache.nearest(self.filename, frame_num,
+                                                        self.reader.format_key)
+        if near_frame is not None:
+            self.show_frame(near_num, near_frame, force=True)
+        self.seek_service.request((self.filename, frame_num))
+    
+    def _load_seek(self, request):
+        filename, frame_num = request
+        return self.get_frame(frame_num) if filename == self.filename else None
+    
+    def _on_seek_ready(self, request, frame):
+        if frame is not None:
+            wx.CallAfter(self._show_seek, request, frame)
+    
+    def _show_seek(self, request, frame):
+        filename, frame_num = request
+        if filename == self.filename and frame_num == self.get_frame_number():
+            self.show_frame(frame_num, frame, force=True)
+    
+    def is_playing(self):
+        return (self.use_pygame and self.pygame_thread.playing and
+                self._playing_file == self.filename)
     
     def play(self, start_frame, playback_speed, reverse=False, skip_frames=False):
-        if self.use_pygame:
-            self.pygame_thread.putQueue(dict(
-                id_string='Start',
-                skip_frames=skip_frames,
-                speed=playback_speed,
-                frame_num=start_frame,
-                num_frames=self.get_number_of_frames(),
-                reverse=reverse,
-                filename=self.filename,
-                plot_function=self.plot_frame
-            ))
+        '''Start playing, or just change the speed, direction and frame
+           skipping if already playing'''
+        if not self.use_pygame:
+            return
+        if self.is_playing():
+            self._set_playback_rate(playback_speed, skip_frames)
+            self.pygame_thread.send(pygame_interface.SetDirection(reverse))
+            return
+        self._playing_file = self.filename
+        self._play_head = start_frame
+        self._play_speed = playback_speed
+        self._play_skip_frames = skip_frames
+        self.pygame_thread.send(pygame_interface.Start(
+            start_frame, self.get_number_of_frames(), playback_speed,
+            reverse=reverse, skip_frames=skip_frames,
+            decoder=self.get_playback_decoder(),
+            plot_function=self.plot_frame, show_function=self.show_frame))
+    
+    def _set_playback_rate(self, speed, skip_frames):
+        '''Send the speed and frame skipping to playback if they changed'''
+        if speed != self._play_speed:
+            self._play_speed = speed
+            self.pygame_thread.send(pygame_interface.SetSpeed(speed))
+        if skip_frames != self._play_skip_frames:
+            self._play_skip_frames = skip_frames
+            self.pygame_thread.send(pygame_interface.SetSkipFrames(skip_frames))
     
     def stop(self):
         if self.use_pygame:
-            self.pygame_thread.putQueue({'id_string': 'Stop'})
-        self.update()
+            self.pygame_thread.send(pygame_interface.Stop())
+        self.show_current_frame()
+    
+    def get_playback_decoder(self):
+        '''Play from the low resolution proxy once it is ready, or with no
+           decoder at all (plot_frame reads the memory map) once the frame
+           store holds the whole clip'''
+        store = self.decode_once_store
+        if (self.decode_once_builder is None and store is not None and
+            len(store) >= self.get_number_of_frames()):
+            return None
+        return self.decoder if self.proxy_decoder is None else self.proxy_decoder
     
-    def load_new_file(self, filename=None):
+    def _on_proxy_progress(self, builder):
+        if builder is not self.proxy_builder: # cancelled or replaced
+            return
+        if not builder.done:
+            self.gui_app.set_status('Building proxy: {:.0%}'.format(builder.progress))
+            return
+        self.gui_app.set_status(None if builder.error is None else
+                                'Proxy failed: ' + builder.error)
+        if builder.output_file and self.proxy_decoder is None:
+            proxy_file = builder.output_file
+            self.proxy_decoder = decode_ahead.DecodeAheadThread(
+                proxy_file, num_frames=self.num_frames,
+                index=frame_index.get_frame_index(proxy_file), timings=self.timings)
+            self.proxy_decoder.start()
+    
+    def load_new_file(self, filename=None, n_threads=None, downscale=1,
+                      proxy_max_shape=None, decode_once=False,
+                      decode_once_max_bytes=frame_store.DEFAULT_MAX_BYTES):
+        '''Open a video file (asking for one if filename is None)
+           n_threads and downscale are decode options (see cv2_utils.VideoReader)
+           Frames stay BGR, which both pygame and matplotlib (through an RGB
+           view) can show without any colour conversion
+           
+           With proxy_max_shape, a low resolution proxy is built in the
+           background (see proxy.ProxyBuilder) and used for playback once
+           ready; paused frames are always shown at full resolution
+           
+           With decode_once, clips that decode to at most decode_once_max_bytes
+           are decoded once into a memory mapped frame store on the local
+           disk (see frame_store) in the background, after which any frame
+           is a page cache lookup; the store is reused while the file is
+           unchanged'''
         filename = wx.FileSelector('Choose a video file') if filename is None else filename
         print(filename)
         if filename == self.filename:    # already loaded
@@ -146,50 +455,197 @@ class OpenCVDataInterface(object):
         if not os.path.exists(filename): # file does not exist
             return
         
+        self._close_file()
         self.filename = filename
         self.mpl_image = None
-        self._video_frame_rate = cv2_utils.get_frame_rate(self.filename)
+        self.audio_stream = self.audio_envelope = None
+        self._audio_envelope_thread = None
+        self.traces = {}
+        self.metrics_cache = None # fingerprinted when the traces are first needed
+        self.scene_cut_frames = None
+        self._scene_cut_thread = self._scene_cut_pending = None
+        decode_options = dict(n_threads=n_threads, downscale=downscale,
+                              timings=self.timings)
+        self.reader = cv2_utils.VideoReader(self.filename, # keep the file open for playback
+                                            **decode_options)
+        self._video_frame_rate = self.reader.frame_rate
         self.get_number_of_frames(rebuild=True) # search for the number of frames
-        self.frame = cv2_utils.get_opencv_frame_as_array(self.filename, 0) # load the first frame
+        if proxy_max_shape is not None:
+            self.proxy_builder = proxy.ProxyBuilder(
+                self.filename, proxy_max_shape,
+                progress_callback=lambda builder: wx.CallAfter(self._on_proxy_progress, builder))
+            if self.proxy_builder.done: # an up to date proxy was already there
+                self._on_proxy_progress(self.proxy_builder)
+        self.decoder = decode_ahead.DecodeAheadThread(self.filename,
+                                                      num_frames=self.num_frames,
+                                                      index=self.reader.index,
+                                                      **decode_options)
+        self.decoder.start()
+        index_thread = threading.Thread(target=self._load_frame_index, args=(self.filename,))
+        index_thread.daemon = True # seeks go by frame count until the index is ready
+        index_thread.start()
+        self.frame = self.get_frame(0) # load the first frame (update reuses it from the cache)
+        self.display_size = (None if self.frame is None else # (W, H), proxy frames
+                             self.frame.shape[1::-1])        # get scaled up to this
+        if decode_once and self.frame is not None:
+            self.open_frame_store(decode_once_max_bytes, decode_options)
         self.gui_app.set_filename(self.filename)
         self.update()
     
+    def _close_file(self):
+        '''Stop playback and the background work on the current file and
+           close its readers'''
+        if self.pygame_thread is not None:
+            self.pygame_thread.stop() # before the readers it plays from are closed
+        self.seek_service.cancel()
+        for job in (self.metrics_computation, self.proxy_builder, self.decode_once_builder):
+            if job is not None:
+                job.cancel()
+        for decoder in (self.decoder, self.proxy_decoder):
+            if decoder is not None:
+                decoder.close()
+        if self.reader is not None:
+            self.reader.release()
+        self.metrics_computation = self.proxy_builder = self.decode_once_builder = None
+        self.decoder = self.proxy_decoder = self.decode_once_store = None
+    
+    def close(self):
+        '''Stop playback and every background thread, e.g. when the app exits'''
+        self._close_file()
+        self.seek_service.close()
+    
+    def open_frame_store(self, max_bytes=frame_store.DEFAULT_MAX_BYTES, decode_options=None):
+        '''Use the saved frame store of this file, or start building one
+           if the decoded clip is under max_bytes (and fits on the disk)'''
+        self.decode_once_store = frame_store.FrameStore.load(self.filename, self.reader.format_key)
+        if self.decode_once_store is not None:
+            return
+        store_dir = os.path.dirname(frame_store.frame_store_filename(self.filename,
+                                                                     self.reader.format_key))
+        if not frame_store.fits(self.num_frames, self.frame.shape, max_bytes, directory=store_dir):
+            return
+        decode_options = {} if decode_options is None else dict(decode_options)
+        decode_options.pop('timings', None) # keep the build out of the playback timings
+        builder = frame_store.FrameStoreBuilder(
+            self.filename, self.num_frames, index=self.reader.index,
+            progress_callback=lambda n_done, n_total: wx.CallAfter(
+                self._on_frame_store_progress, builder),
+            **decode_options)
+        self.decode_once_builder = builder
+        self.decode_once_store = builder.store # None until the first frame is written
+        builder.start()
+    
+    def _on_frame_store_progress(self, builder):
+        if builder is not self.decode_once_builder: # cancelled or replaced
+            return
+        self.decode_once_store = builder.store # frames decoded so far are usable already
+        if not builder.done:
+            self.gui_app.set_status('Decoding frames: {:.0%}'.format(builder.progress))
+            return
+        self.decode_once_builder = None
+        self.gui_app.set_status(None if builder.error is None else
+                                'Frame store failed: ' + builder.error)
+    
+    def _load_frame_index(self, filename):
+        index = frame_index.get_frame_index(filename) # a packet scan the first time
+        wx.CallAfter(self._set_frame_index, filename, index)
+    
+    def _set_frame_index(self, filename, index):
+        '''Switch to exact keyframe seeks once the index is ready'''
+        if filename == self.filename:
+            self.reader.set_index(index)
+            self.decoder.set_index(index)
+    
     def get_number_of_frames(self, rebuild=False):
         if rebuild or self.num_frames is None:
-            self.num_frames = int(cv2_utils.binary_search_end(self.filename) + 1)
+            self.num_frames = cv2_utils.count_frames(self.reader)
         return self.num_frames
     
+    def get_scene_cuts(self, on_ready=None):
+        '''Frame numbers of the scene cuts, or None while they are being found
+           The first call starts finding them in the background (if they
+           aren't saved already); on_ready() is called once they are there,
+           e.g. to finish the jump that asked for them'''
+        if not self.filename:
+            return []
+        if self.scene_cut_frames is not None:
+            return self.scene_cut_frames
+        self._scene_cut_pending = on_ready
+        if self._scene_cut_thread is None:
+            self._scene_cut_thread = threading.Thread(target=self._find_scene_cuts,
+                                                      args=(self.filename, self.reader.index))
+            self._scene_cut_thread.daemon = True
+            self._scene_cut_thread.start()
+            self.gui_app.set_status('Finding scene cuts...')
+        return None
+    
+    def _find_scene_cuts(self, filename, index):
+        cuts = None
+        try:
+            cuts = scene_cuts.get_scene_cuts(filename, index=index, # stop if the file changes
+                                             progress_callback=lambda n: filename != self.filename)
+        finally: # even if it failed, so the next request tries again
+            wx.CallAfter(self._set_scene_cuts, filename, cuts)
+    
+    def _set_scene_cuts(self, filename, cuts):
+        if filename != self.filename:
+            return
+        self._scene_cut_thread = None
+        on_ready, self._scene_cut_pending = self._scene_cut_pending, None
+        if cuts is None:
+            self.gui_app.set_status('Could not find the scene cuts')
+            return
+        self.gui_app.set_status(None)
+        self.scene_cut_frames = cuts.tolist()
+        if on_ready is not None:
+            on_ready()
+    
     def get_frame_number(self):
         frame_num = int(self.gui_app.video_frame.get_frame_number())
         return frame_num
     
     def get_frame_time(self, frame_num=None):
+        '''Get the time (s) of a frame number (or an array of them)'''
         frame_num = (frame_num if frame_num is not None else
                      self.get_frame_number())
+        if self.reader is not None and self.reader.index is not None:
+            index = self.reader.index
+            return index.frame_to_msec(np.clip(frame_num, 0, len(index) - 1)) / 1000.
         return frame_num / self._video_frame_rate
     
+    def get_frame_at_time(self, t):
+        '''Inverse of get_frame_time (t in seconds)'''
+        if self.reader is not None and self.reader.index is not None:
+            return int(self.reader.index.msec_to_frame(1000. * t))
+        return t * self._video_frame_rate
+    
     def pygame_callback(self, frame_number):
         '''Everything to run during the pygame thread updating'''
+        start = perf.now()
+        self._play_head = frame_number # before the text box echoes it to update()
         self.gui_app.video_frame.set_frame_number_no_update(frame_number)
-        
-        # Skip if the draw is in progress or it is less than 10 ms after the last draw finished
-        # This allows the wxPython GUI time in the thread to respond
-        # (tests to run matplotlib in a separate thread totally flopped)
-        WAIT_TIME = 0.01
-        
-        # If the timer is up, release the lock
-        if (self._lock_finished_time is not None and
-            self._lock_finished_time + WAIT_TIME < time.time()):
-            self._lock_finished_time = None
-        
-        if self._lock_finished_time is None:
-            self._lock_finished_time = -1
-            self.update_vline(frame_number)
-            self._lock_finished_time = time.time()
+        self.update_vline(frame_number) # cheap now that the cursor is blitted
+        self.timings.lap('gui_callback', frame_number, start)
+    
+    def show_hud(self, show=True):
+        '''Overlay the fps, dropped frames and stage timings on the pygame window'''
+        self.pygame_plot_object.hud_function = (
+            (lambda: perf.hud_lines(self.timings, self.pygame_thread.clock))
+            if show else None)
+    
+    def dump_timings(self, filename):
+        '''Save the recorded stage timings as CSV (see perf.StageTimings.to_csv)'''
+        self.timings.to_csv(filename)
+
+def get_trace_names():
+    '''Names for the trace checkboxes: the audio envelope and every registered metric'''
+    return ['audio'] + list(metrics.METRICS)
 
 class VideoApp(wx.App):
     def __init__(self, *args, **kwds):
-        self.traces_checkbox_names = kwds.pop('traces_checkbox_names', [])
+        self.traces_checkbox_names = kwds.pop('traces_checkbox_names', None)
+        if self.traces_checkbox_names is None:
+            self.traces_checkbox_names = get_trace_names()
         wx.App.__init__(self, *args, **kwds)
 
     def OnInit(self):
@@ -203,6 +659,11 @@ class VideoApp(wx.App):
     def set_filename(self, filename):
         self.video_frame.file_name_textbox.SetValue(filename)
 
+    def set_status(self, status=None):
+        '''Show a progress message in the title bar (None to clear it)'''
+        title = self.video_frame.GetTitle().split(' - ')[0]
+        self.video_frame.SetTitle(title if status is None else title + ' - ' + status)
+
     def get_frame_number(self):
         return self.video_frame.get_frame_number()
 
@@ -226,3 +687,4 @@ if __name__ == "__main__":
     # Start the pygame and wxPython threads
     pygame_thread.start()
     gui_app.MainLoop()
+    dat.close()
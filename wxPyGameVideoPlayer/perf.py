@@ -0,0 +1,117 @@
+'''Timing of each stage of the playback pipeline
+
+A StageTimings object is shared by the pieces of the pipeline (the
+VideoReader, the pygame window and thread, the GUI callback), which
+record how long each stage took for each frame. Samples go into a
+fixed-size ring per stage, so recording costs the same whether
+playback has run for a second or a day and never allocates.
+
+Stages:
+    seek:         moving the reader to a requested frame
+    decode:       reading (decoding) the frame
+    convert:      pixel format conversion / downscaling
+    upload:       wrapping (and scaling) the frame as a pygame surface
+    present:      the blit to the window and the display update
+    pace:         waiting for the frame's deadline
+    gui_callback: the per-frame work on the wx thread
+
+Summaries (percentiles per stage, effective fps) feed the pygame HUD and
+to_csv dumps the raw samples for offline analysis.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .playback_clock import now
+
+STAGES = ('seek', 'decode', 'convert', 'upload', 'present', 'pace', 'gui_callback')
+
+class StageTimings(object):
+    '''Fixed-size rings of (wall time, frame number, seconds) for each stage'''
+    def __init__(self, n_samples=2000, stages=STAGES):
+        self.n_samples = n_samples
+        self.lock = threading.Lock()
+        self._rings = OrderedDict((stage, np.zeros((n_samples, 3))) for stage in stages)
+        self._counts = dict((stage, 0) for stage in stages)
+
+    def record(self, stage, frame_number, seconds, t=None):
+        t = now() if t is None else t
+        with self.lock:
+            if stage not in self._rings: # new stages can be added on the fly
+                self._rings[stage] = np.zeros((self.n_samples, 3))
+                self._counts[stage] = 0
+            count = self._counts[stage]
+            self._rings[stage][count % self.n_samples] = t, frame_number, seconds
+            self._counts[stage] = count + 1
+
+    def lap(self, stage, frame_number, start):
+        '''Record the time since start (from now()) and return now(),
+           so consecutive stages can be timed like a stopwatch'''
+        t = now()
+        self.record(stage, frame_number, t - start, t)
+        return t
+
+    def clear(self):
+        with self.lock:
+            for stage in self._counts:
+                self._counts[stage] = 0
+
+    @property
+    def stages(self):
+        return list(self._rings)
+
+    def samples(self, stage):
+        '''The stored (wall time, frame number, seconds) rows, oldest first'''
+        with self.lock:
+            ring, count = self._rings[stage], self._counts[stage]
+            if count <= self.n_samples:
+                return ring[:count].copy()
+            return np.roll(ring, -(count % self.n_samples), axis=0)
+
+    def percentiles(self, stage, q=(50, 95, 99)):
+        '''Percentiles of a stage's duration in seconds (NaN without samples)'''
+        seconds = self.samples(stage)[:, 2]
+        if len(seconds) == 0:
+            return [np.nan] * len(q)
+        return list(np.percentile(seconds, q))
+
+    def rate(self, stage='present', window=1.0):
+        '''How many times per second a stage ran over the last window seconds
+           (the effective fps for "present")'''
+        times = self.samples(stage)[:, 0]
+        times = times[times >= now() - window]
+        if len(times) < 2:
+            return 0.
+        return (len(times) - 1) / max(times[-1] - times[0], 1e-9)
+
+    def summary(self, q=(50, 95)):
+        '''OrderedDict of stage -> (n_samples, percentiles in ms) for stages with samples'''
+        result = OrderedDict()
+        for stage in self.stages:
+            n = min(self._counts[stage], self.n_samples)
+            if n:
+                result[stage] = (n, [1000 * float(p) for p in self.percentiles(stage, q)])
+        return result
+
+    def to_csv(self, filename):
+        '''Write all stored samples, one row per (stage, frame)'''
+        with open(filename, 'w') as fid:
+            fid.write('stage,wall_time,frame_number,seconds\n')
+            for stage in self.stages:
+                for t, frame_number, seconds in self.samples(stage):
+                    fid.write('{},{!r},{},{!r}\n'.format(stage, float(t), int(frame_number),
+                                                         float(seconds)))
+
+def hud_lines(timings, clock=None):
+    '''Text for the playback HUD: effective fps, drops and stage percentiles'''
+    line = 'fps {:5.1f}'.format(timings.rate('present'))
+    if clock is not None:
+        line += '   dropped {}'.format(clock.n_dropped)
+    lines = [line, 'stage          p50    p95 (ms)']
+    for stage, (_, (p50, p95)) in timings.summary((50, 95)).items():
+        lines.append('{:<12} {:6.2f} {:6.2f}'.format(stage, p50, p95))
+    return lines
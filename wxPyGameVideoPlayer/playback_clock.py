@@ -0,0 +1,78 @@
+'''A sleep-based playback clock with absolute frame deadlines
+
+Every frame's deadline is measured from the moment playback started
+(start_wall_time + frames_so_far / speed) instead of from the previous
+frame, so timing errors don't accumulate over a long run. Waiting sleeps
+until just before the deadline and then yields in tiny sleeps, which
+leaves the CPU (and the GIL) to the wx main loop and the decoder.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+from collections import deque
+
+import numpy as np
+
+now = getattr(time, 'perf_counter', time.time)
+
+class PlaybackClock(object):
+    spin_time = 0.002 # stop sleeping this long before a deadline and
+                      # poll instead (sleep granularity is ~1ms on most OS's)
+
+    def __init__(self, speed, start_frame=0, step=1, skip_frames=False, n_samples=1000):
+        self.skip_frames = skip_frames
+        self.lateness = deque(maxlen=n_samples) # seconds late for each frame shown
+        self.n_dropped = 0
+        self.restart(start_frame, speed, step)
+
+    def restart(self, start_frame, speed=None, step=None):
+        '''Measure deadlines from start_frame, starting now
+           (also used to change speed or direction mid-playback)'''
+        self.speed = self.speed if speed is None else speed
+        self.step = self.step if step is None else step
+        self.start_frame = start_frame
+        self.start_wall_time = now()
+
+    def deadline(self, frame_number):
+        return (self.start_wall_time +
+                self.step * (frame_number - self.start_frame) / self.speed)
+
+    def wait_for(self, frame_number):
+        '''Wait until it is time to show frame_number
+           Returns how late (in seconds) the frame is'''
+        deadline = self.deadline(frame_number)
+        remaining = deadline - now()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while now() < deadline:
+            time.sleep(0) # yield to other threads
+        late = now() - deadline
+        self.lateness.append(late)
+        if not self.skip_frames and late > 1 / self.speed:
+            # Running behind without skipping: pace from here on instead
+            # of rushing through frames to catch up
+            self.restart(frame_number)
+        return late
+
+    def next_frame(self, frame_number):
+        '''Get the frame to show after frame_number
+           With skip_frames, this jumps to wherever the clock says the
+           play head should be now (counting the frames dropped)'''
+        next_frame = frame_number + self.step
+        if self.skip_frames:
+            time_so_far = now() - self.start_wall_time
+            frame_jump = self.start_frame + int(self.step * self.speed * time_so_far)
+            if self.step * (frame_jump - next_frame) > 0: # multiplying by step ensures you get positive numbers
+                self.n_dropped += self.step * (frame_jump - next_frame)
+                next_frame = frame_jump
+        return next_frame
+
+    def stats(self):
+        '''Summary of the measured jitter (lateness in seconds) and drops'''
+        late = np.array(self.lateness)
+        if len(late) == 0:
+            return dict(n_frames=0, n_dropped=self.n_dropped)
+        return dict(n_frames=len(late), n_dropped=self.n_dropped,
+                    mean_late=late.mean(), std_late=late.std(),
+                    max_late=late.max(), p95_late=np.percentile(late, 95))
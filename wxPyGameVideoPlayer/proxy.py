@@ -0,0 +1,181 @@
+'''Low resolution preview proxies of a video, generated in-process
+
+A proxy has exactly the same frames as the source, just smaller, so
+frame numbers line up and the player can scrub/play on the proxy and
+switch back to full resolution when paused.
+Frames are streamed through a VideoReader, resized a batch at a time
+and written with cv2.VideoWriter; the proxy's FrameIndex is written
+alongside it. ProxyBuilder runs all of this in a background process,
+started with the "spawn" method since forking a threaded GUI process
+can deadlock the child.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import threading
+import multiprocessing
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+import numpy as np
+import cv2
+
+from . import cv2_utils
+from . import frame_index
+from .cache_utils import sidecar_filename, replace_file
+
+_mp = (multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else
+       multiprocessing) # Python 2 can only fork
+
+def fit_shape(shape, max_shape):
+    '''Get the (width, height) that fits (height, width) shape into a
+       max_shape box (a number or (max_w, max_h)), keeping the aspect ratio'''
+    max_w, max_h = (
+        max_shape if hasattr(max_shape, "__len__") else (max_shape, max_shape)
+    )
+    height, width = shape[:2]
+    scale = min(max_w / width, max_h / height, 1)
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+def proxy_filename(video_file, max_shape):
+    max_w, max_h = (
+        max_shape if hasattr(max_shape, "__len__") else (max_shape, max_shape)
+    )
+    return sidecar_filename(video_file, 'proxy_fit_to_{}_{}'.format(max_w, max_h), '.avi')
+
+def proxy_is_current(video_file, output_file):
+    return (os.path.exists(output_file) and
+            os.path.getmtime(output_file) >= os.path.getmtime(video_file))
+
+def create_proxy(video_file, max_shape=480, output_file=None, batch_size=32,
+                 fourcc='MJPG', progress_callback=None):
+    '''Write a copy of video_file that fits into a max_shape box
+
+       progress_callback(n_done, n_total) is called after each batch
+       (returning True from it cancels the job)
+       Returns the proxy's filename (or None if cancelled)'''
+    output_file = (proxy_filename(video_file, max_shape) if output_file is None else
+                   output_file)
+    base, ext = os.path.splitext(output_file)
+    temp_file = base + '.tmp' + ext # VideoWriter picks the container from the extension
+
+    with cv2_utils.VideoReader(video_file) as reader:
+        n_total = cv2_utils.count_frames(reader)
+        ret, frame = reader.read(0)
+        if not ret:
+            raise IOError('Could not read frames from {}'.format(video_file))
+        width, height = fit_shape(frame.shape, max_shape)
+        writer = cv2.VideoWriter(temp_file, cv2.VideoWriter_fourcc(*fourcc),
+                                 reader.frame_rate, (width, height))
+        try:
+            if not writer.isOpened():
+                raise IOError('Could not open a {} writer for {}'.format(fourcc, temp_file))
+
+            batch = np.empty((batch_size,) + frame.shape, dtype=frame.dtype)
+            small = np.empty((batch_size, height, width) + frame.shape[2:], dtype=frame.dtype)
+            batch[0] = frame
+            n_done, n_batch = 0, 1
+            while True:
+                while n_batch < batch_size: # decode sequentially into the batch
+                    ret, _ = reader.read(out=batch[n_batch])
+                    if not ret:
+                        break
+                    n_batch += 1
+                for i in range(n_batch):
+                    cv2.resize(batch[i], (width, height), dst=small[i],
+                               interpolation=cv2.INTER_AREA)
+                    writer.write(small[i])
+                n_done += n_batch
+                if progress_callback is not None and progress_callback(n_done, n_total):
+                    return None # cancelled
+                if n_batch < batch_size: # the stream ended
+                    break
+                n_batch = 0
+            writer.release()
+            replace_file(temp_file, output_file)
+            temp_file = None # kept
+        finally:
+            writer.release() # a no-op if already released
+            if temp_file is not None and os.path.exists(temp_file): # cancelled or failed
+                os.remove(temp_file)
+
+    frame_index.get_frame_index(output_file, rebuild=True)
+    return output_file
+
+def _proxy_worker(video_file, max_shape, output_file, progress_queue, cancel_event):
+    def progress_callback(n_done, n_total):
+        progress_queue.put(('progress', n_done, n_total))
+        return cancel_event.is_set()
+    try:
+        result = create_proxy(video_file, max_shape, output_file,
+                              progress_callback=progress_callback)
+        progress_queue.put(('done', result, None))
+    except Exception as e:
+        progress_queue.put(('error', str(e), None))
+
+class ProxyBuilder(object):
+    '''Build a proxy in a background process
+
+       progress is the fraction done and output_file is set when finished.
+       With a progress_callback, a listener thread collects the progress
+       and calls progress_callback(builder) for every update (including
+       the last, when done is set); otherwise call poll() to collect it'''
+    def __init__(self, video_file, max_shape=480, output_file=None, progress_callback=None):
+        self.video_file = video_file
+        self.output_file = None
+        self.error = None
+        self.progress = 0.
+        self.done = False
+        self.progress_callback = progress_callback
+        target_file = (proxy_filename(video_file, max_shape) if output_file is None else
+                       output_file)
+        if proxy_is_current(video_file, target_file):
+            self.output_file, self.progress, self.done = target_file, 1., True
+            self.process = None
+            return
+        self.progress_queue = _mp.Queue()
+        self.cancel_event = _mp.Event()
+        self.process = _mp.Process(
+            target=_proxy_worker,
+            args=(video_file, max_shape, target_file, self.progress_queue, self.cancel_event))
+        self.process.daemon = True
+        self.process.start()
+        if progress_callback is not None:
+            listener = threading.Thread(target=self._listen)
+            listener.daemon = True
+            listener.start()
+
+    def _handle(self, message):
+        kind, value, total = message
+        if kind == 'progress':
+            self.progress = value / max(total, 1)
+        else:
+            self.process.join()
+            self.output_file = value if kind == 'done' else None
+            self.error = value if kind == 'error' else None
+            self.done = True
+
+    def _listen(self):
+        while not self.done:
+            try:
+                message = self.progress_queue.get(timeout=1.)
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+                message = ('error', 'the proxy process exited early', None)
+            self._handle(message)
+            self.progress_callback(self)
+
+    def poll(self):
+        '''Collect progress messages, returns True once finished'''
+        while (self.progress_callback is None and not self.done and
+               not self.progress_queue.empty()):
+            self._handle(self.progress_queue.get())
+        return self.done
+
+    def cancel(self):
+        if self.process is not None and not self.done:
+            self.cancel_event.set()
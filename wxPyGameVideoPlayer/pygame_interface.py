@@ -2,93 +2,321 @@
 
 from __future__ import absolute_import
 
-import sys
-import time
 import threading
 
-if sys.version[0] == '2':
-    import Queue as queue
-else:
-    import queue as queue
-
 import numpy as np
-import wx
 import pygame
 
-import attrdict
+from .playback_clock import PlaybackClock, now
 
 class PygamePlotObject(object):
+    '''A pygame window to show frames in
+       
+       Set timings (a perf.StageTimings) to record the upload and present
+       time of each frame, and hud_function (returning a list of strings,
+       e.g. from perf.hud_lines) to overlay text on every frame
+       The HUD text is only refreshed every hud_interval seconds, so
+       working it out stays out of the per frame cost being measured'''
+    timings = None
+    hud_function = None
+    hud_interval = 0.5
+    
     def __init__(self):
         pygame.init()
+        self._font = None
+        self._hud_surfaces = None # the rendered HUD lines, redrawn every hud_interval
+        self._hud_time = None
         self._set_screen_res((10, 10))
     
     def _set_screen_res(self, shape, scale=(1, 1)):
         self.shape = shape
         self.screen = pygame.display.set_mode((self.shape[0] * scale[0], self.shape[1] * scale[1]))
         self.scale_screen = pygame.surface.Surface(self.shape)
+        self._scaled_surface = None # reused by imshow_bgr when the window size differs
     
-    def imshow(self, dat, scale=(1, 1), transpose=False):
-        dat = np.asarray(dat, dtype=np.int32)
-        dat = (np.transpose(dat, (1,0,2)) if transpose else dat)
-        dat_shape = dat.shape[:2]
+    def _check_screen_res(self, dat_shape):
         if dat_shape != self.shape:
             self._set_screen_res(dat_shape, scale=(1, 1))
             pygame.display.set_caption('ImShow...with Pygame')
             black = 20, 20, 40
             self.screen.fill(black)
             self.scale_screen.fill(black)
-        pygame.surfarray.blit_array(self.scale_screen, dat)
-        temp = pygame.transform.scale(self.scale_screen, self.screen.get_size())
-        self.screen.blit(temp, (0,0))
+    
+    def _present(self, surface, frame_number=-1, start=None):
+        '''Draw a frame surface to the window, scaling only if needed
+           (start is when the upload began, for the timings)'''
+        screen_size = self.screen.get_size()
+        if surface.get_size() != screen_size:
+            if (self._scaled_surface is None or
+                self._scaled_surface.get_size() != screen_size or
+                self._scaled_surface.get_bitsize() != surface.get_bitsize()):
+                self._scaled_surface = pygame.Surface(screen_size, 0, surface)
+            surface = pygame.transform.scale(surface, screen_size, self._scaled_surface)
+        timings = self.timings
+        if timings is not None and start is not None:
+            start = timings.lap('upload', frame_number, start)
+        self.screen.blit(surface, (0,0))
+        if self.hud_function is not None:
+            self._draw_hud()
         pygame.display.update()
+        if timings is not None and start is not None:
+            timings.lap('present', frame_number, start)
+    
+    def _draw_hud(self):
+        t = now()
+        if self._hud_surfaces is None or t - self._hud_time >= self.hud_interval:
+            if self._font is None:
+                self._font = pygame.font.SysFont('monospace', 14)
+            self._hud_surfaces = [self._font.render(line, True, (255, 255, 255), (0, 0, 0))
+                                  for line in self.hud_function()]
+            self._hud_time = t
+        y = 4
+        for text in self._hud_surfaces:
+            self.screen.blit(text, (4, y))
+            y += text.get_height()
+    
+    def imshow(self, dat, scale=(1, 1), transpose=False):
+        dat = np.asarray(dat)
+        if dat.dtype != np.uint8:
+            dat = np.asarray(dat, dtype=np.int32)
+        dat = (np.transpose(dat, (1,0,2)) if transpose else dat)
+        self._check_screen_res(dat.shape[:2])
+        pygame.surfarray.blit_array(self.scale_screen, dat)
+        self._present(self.scale_screen)
     
     def imshowT(self, dat, scale=(1, 1)):
         return self.imshow(dat, scale=scale, transpose=True)
+    
+    def imshow_bgr(self, frame, size=None, frame_number=-1):
+        '''Fast path for a uint8 (H, W, 3) BGR frame straight from OpenCV
+           
+           The frame's memory is wrapped in a surface without copying or
+           converting it (channel order and the (W, H) layout are handled
+           by SDL), so the only copy is the blit to the window.
+           size (W, H) fixes the window size (e.g. to show a low resolution
+           proxy at full size); by default the window matches the frame'''
+        start = now() if self.timings is not None else None
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        height, width = frame.shape[:2]
+        self._check_screen_res((width, height) if size is None else tuple(size))
+        try:
+            surface = pygame.image.frombuffer(frame, (width, height), 'BGR')
+        except ValueError: # pygame < 2.1.3 has no BGR buffers
+            surface = (self.scale_screen if self.scale_screen.get_size() == (width, height) else
+                       pygame.surface.Surface((width, height)))
+            pixels = pygame.surfarray.pixels3d(surface)
+            pixels[...] = frame.swapaxes(0, 1)[:, :, ::-1] # a single copy into the surface
+            del pixels # unlock the surface
+        self._present(surface, frame_number, start)
+
+class Command(object):
+    '''Base class for the messages sent to a PygameThread'''
+    __slots__ = ()
+
+class Start(Command):
+    '''Play frames [0, num_frames) from frame_num at speed (Hz)
+       
+       With a decoder (see decode_ahead.DecodeAheadThread), frames are
+       pulled from it and passed to show_function(frame_num, frame),
+       otherwise plot_function(frame_num) decodes and shows each frame'''
+    __slots__ = ('frame_num', 'num_frames', 'speed', 'reverse', 'skip_frames',
+                 'decoder', 'plot_function', 'show_function')
+    def __init__(self, frame_num, num_frames, speed, reverse=False, skip_frames=False,
+                 decoder=None, plot_function=None, show_function=None):
+        self.frame_num = frame_num
+        self.num_frames = num_frames
+        self.speed = speed
+        self.reverse = reverse
+        self.skip_frames = skip_frames
+        self.decoder = decoder
+        self.plot_function = plot_function
+        self.show_function = show_function
+
+class Stop(Command):
+    '''Stop playing; done (a threading.Event) is set once playback has
+       stopped, i.e. nothing is read from the decoder any more'''
+    __slots__ = ('done',)
+    def __init__(self, done=None):
+        self.done = done
+
+class Seek(Command):
+    __slots__ = ('frame_num',)
+    def __init__(self, frame_num):
+        self.frame_num = frame_num
+
+class SetSpeed(Command):
+    __slots__ = ('speed',)
+    def __init__(self, speed):
+        self.speed = speed
+
+class SetDirection(Command):
+    __slots__ = ('reverse',)
+    def __init__(self, reverse):
+        self.reverse = reverse
+
+class SetSkipFrames(Command):
+    __slots__ = ('skip_frames',)
+    def __init__(self, skip_frames):
+        self.skip_frames = skip_frames
+
+class CommandChannel(object):
+    '''Commands for a PygameThread, merged as they arrive
+       
+       Only the latest of each kind matters: a Start or Stop replaces
+       everything before it and a new Seek, SetSpeed, SetDirection or
+       SetSkipFrames replaces the previous one of its kind, so a burst of commands is
+       handled in one go. pending can be checked every frame without
+       locking or allocating anything.'''
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = False
+        self._clear()
+
+    def _clear(self):
+        self.start = None
+        self.stop = None
+        self.seek = None
+        self.speed = None
+        self.reverse = None
+        self.skip_frames = None
+
+    def send(self, command):
+        with self.condition:
+            if isinstance(command, Start):
+                self._clear()
+                self.start = command
+            elif isinstance(command, Stop):
+                self._clear()
+                self.stop = command
+            elif isinstance(command, Seek):
+                self.seek = command.frame_num
+            elif isinstance(command, SetSpeed):
+                self.speed = command.speed
+            elif isinstance(command, SetDirection):
+                self.reverse = command.reverse
+            elif isinstance(command, SetSkipFrames):
+                self.skip_frames = command.skip_frames
+            else:
+                raise TypeError('Not a playback command: {!r}'.format(command))
+            self.pending = True
+            self.condition.notify()
+
+    def take(self, block=True):
+        '''Get the merged commands as
+           (start, stop, seek, speed, reverse, skip_frames),
+           waiting for some if block is set'''
+        with self.condition:
+            while block and not self.pending:
+                self.condition.wait()
+            merged = (self.start, self.stop, self.seek, self.speed, self.reverse,
+                      self.skip_frames)
+            self._clear()
+            self.pending = False
+            return merged
+
+def _stopped(stop):
+    if stop is not None and stop.done is not None:
+        stop.done.set()
 
 class PygameThread(threading.Thread):
-    def __init__(self, gui_callback):
+    '''Play frames on a thread of its own, reporting each frame number to
+       gui_callback on the GUI thread through call_after(function, *args)
+       (wx.CallAfter unless given, so wx is only needed for the default)'''
+    def __init__(self, gui_callback, call_after=None):
         threading.Thread.__init__(self)
+        if call_after is None:
+            import wx
+            call_after = wx.CallAfter
         self.gui_callback = gui_callback
-        self.queue = queue.Queue()
+        self.call_after = call_after
+        self.channel = CommandChannel()
+        self.playing = False
+        self.clock = None # the PlaybackClock from the latest playback (see clock.stats())
+        self.timings = None # set to a perf.StageTimings to record the pacing
         self.setDaemon(True)
 
+    def send(self, command):
+        '''Send a Start, Stop, Seek, SetSpeed, SetDirection or SetSkipFrames command'''
+        self.channel.send(command)
+
+    def stop(self, timeout=5.):
+        '''Stop playing and wait until playback has actually stopped
+           Returns False if that took longer than timeout'''
+        if not self.is_alive():
+            return True
+        done = threading.Event()
+        self.send(Stop(done))
+        return done.wait(timeout)
+
+    def putQueue(self, arg):
+        '''Old style dict commands ({'id_string': 'Start', ...} or 'Stop')'''
+        arg = dict(arg)
+        if arg.pop('id_string') == 'Start':
+            arg.pop('filename', None)
+            self.send(Start(**arg))
+        else:
+            self.send(Stop())
+
     def run(self):
         while True:
-            qval = attrdict.AttrDict(self.queue.get(True))
-            if qval.id_string == 'Stop':
-                pass
-            if qval.id_string == 'Start':
-                print('reverse is', qval.reverse)
-                step, test = ((-1, lambda x: x > 0)
-                              if qval.reverse else
-                              (1, lambda x: x < qval.num_frames))
-                
-                start_wall_time = time.time()
-                start_frame = qval.frame_num
-                cur_frame = qval.frame_num
-                while test(cur_frame):
-                    t = time.time()
-                    
-                    if self.queue.qsize() > 0:
-                        qval = attrdict.AttrDict(self.queue.get(True))
-                    if qval.id_string == 'Stop':
-                        break
-                    
-                    wx.CallAfter(self.gui_callback, cur_frame) # send the frame number back to the GUI to update
-                    
-                    qval.plot_function(cur_frame)
-                    print('show frame', cur_frame)
-                    
-                    while time.time()<t+(1.0/qval.speed):
-                        pass
-                    
-                    cur_frame = cur_frame + step
-                    
-                    if qval.skip_frames:
-                        time_so_far = t - start_wall_time
-                        frame_jump = start_frame + int(step * qval.speed * time_so_far)
-                        if step * (frame_jump-cur_frame) > 0: # multiplying by step ensures you get positive numbers
-                            cur_frame = frame_jump
-    
-    def putQueue(self,arg):
-        self.queue.put_nowait(arg)
+            start, stop = self.channel.take()[:2]
+            _stopped(stop)
+            while start is not None:
+                start = self._play(start) # returns a Start that interrupted playback
+
+    def _play(self, start):
+        '''Play until the end or a Stop; Seek, SetSpeed, SetDirection and
+           SetSkipFrames are applied on the fly. Returns a new Start if one
+           came in. Both ends are shown, so playing in reverse stops after
+           frame 0.'''
+        step = -1 if start.reverse else 1
+        num_frames = start.num_frames
+        decoder = start.decoder
+        if decoder is not None:
+            decoder.retarget(start.frame_num, step) # no restart, just a new target
+        
+        self.clock = PlaybackClock(start.speed, start.frame_num, step, start.skip_frames)
+        cur_frame = start.frame_num
+        next_start = stop = None
+        self.playing = True
+        while 0 <= cur_frame < num_frames:
+            if self.channel.pending:
+                (next_start, stop, seek, speed, reverse,
+                 skip_frames) = self.channel.take(block=False)
+                if stop or next_start is not None:
+                    break
+                if reverse is not None:
+                    step = -1 if reverse else 1
+                if skip_frames is not None:
+                    self.clock.skip_frames = skip_frames
+                if seek is not None:
+                    cur_frame = min(max(int(seek), 0), num_frames - 1)
+                self.clock.restart(cur_frame, speed, step)
+                if decoder is not None and (seek is not None or reverse is not None):
+                    decoder.retarget(cur_frame, step)
+            
+            self.call_after(self.gui_callback, cur_frame) # send the frame number back to the GUI to update
+            
+            if decoder is None:
+                self._wait_for(cur_frame)
+                start.plot_function(cur_frame)
+            else:
+                frame = decoder.get_frame(cur_frame)
+                self._wait_for(cur_frame) # present on time, decode beforehand
+                if frame is not None:
+                    start.show_function(cur_frame, frame)
+            
+            cur_frame = self.clock.next_frame(cur_frame)
+        
+        self.playing = False
+        if decoder is not None and next_start is None:
+            decoder.pause() # drain the buffer
+        _stopped(stop)
+        return next_start
+
+    def _wait_for(self, frame_number):
+        timings = self.timings
+        start = now() if timings is not None else None
+        self.clock.wait_for(frame_number)
+        if timings is not None:
+            timings.lap('pace', frame_number, start)
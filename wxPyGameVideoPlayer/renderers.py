@@ -0,0 +1,113 @@
+'''Send decoded frames to any number of displays ("sinks"), each at its own rate
+
+Every sink declares a max_rate (Hz, None for no limit). The renderer
+only hands a sink a frame if enough time has passed since its last one;
+otherwise the frame is dropped for that sink, so a slow display (like
+matplotlib) never holds back a fast one (like pygame).
+
+Sinks with gui_thread set are drawn on the GUI thread via wx.CallAfter
+(wx is only imported once such a sink gets a frame, so the renderer
+itself works headless).
+Only the latest frame is kept for them: if a frame arrives while the
+previous one is still waiting to be drawn, it simply replaces it.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import threading
+
+import numpy as np
+
+from .playback_clock import now
+
+class FrameSink(object):
+    '''Base class for a display, subclasses implement show(frame_number, frame)
+       (frame is a uint8 (H, W, 3) BGR array)'''
+    max_rate = None    # Hz, None for every frame
+    gui_thread = False # True to always draw on the wx thread
+
+    def show(self, frame_number, frame):
+        raise NotImplementedError
+
+class PygameSink(FrameSink):
+    '''Show frames in the pygame window (see pygame_interface.PygamePlotObject)
+       get_size() gives the window size (W, H) or None to match the frame'''
+    def __init__(self, plot_object, get_size=None, max_rate=None):
+        self.plot_object = plot_object
+        self.get_size = get_size
+        self.max_rate = max_rate
+
+    def show(self, frame_number, frame):
+        size = None if self.get_size is None else self.get_size()
+        self.plot_object.imshow_bgr(frame, size=size, frame_number=frame_number)
+
+class MplSink(FrameSink):
+    '''Show frames with a matplotlib imshow function (which gets an RGB view)'''
+    gui_thread = True
+
+    def __init__(self, imshow_function, max_rate=10):
+        self.imshow_function = imshow_function
+        self.max_rate = max_rate
+
+    def show(self, frame_number, frame):
+        self.imshow_function(frame[:, :, ::-1])
+
+class _SinkState(object):
+    __slots__ = ('sink', 'last_time', 'pending', 'scheduled')
+    def __init__(self, sink):
+        self.sink = sink
+        self.last_time = None
+        self.pending = None    # latest (frame_number, frame) for gui_thread sinks
+        self.scheduled = False # a wx.CallAfter is on its way
+
+class FrameRenderer(object):
+    '''Fan frames out to a set of sinks, see the module docstring'''
+    def __init__(self, sinks=(), call_after=None):
+        self.lock = threading.Lock()
+        self._states = [_SinkState(sink) for sink in sinks]
+        self.call_after = call_after # how to run on the GUI thread, wx.CallAfter by default
+
+    def add_sink(self, sink):
+        with self.lock:
+            self._states.append(_SinkState(sink))
+        return sink
+
+    def remove_sink(self, sink):
+        with self.lock:
+            self._states = [state for state in self._states if state.sink is not sink]
+
+    @property
+    def sinks(self):
+        return [state.sink for state in self._states]
+
+    def submit(self, frame_number, frame, force=False):
+        '''Offer a frame to every sink; force ignores the rate limits
+           (for a paused frame, which must always be shown)
+           The frame may be a reused buffer: it is only copied for sinks
+           that draw later on the wx thread'''
+        t = now()
+        for state in list(self._states):
+            sink = state.sink
+            if (not force and sink.max_rate and state.last_time is not None and
+                t - state.last_time < 1. / sink.max_rate):
+                continue # too soon, drop it for this sink
+            state.last_time = t
+            if not sink.gui_thread:
+                sink.show(frame_number, frame)
+                continue
+            with self.lock:
+                state.pending = (frame_number, np.array(frame))
+                if state.scheduled: # the waiting call will pick up this frame instead
+                    continue
+                state.scheduled = True
+            if self.call_after is None:
+                import wx
+                self.call_after = wx.CallAfter
+            self.call_after(self._show_pending, state)
+
+    def _show_pending(self, state):
+        with self.lock:
+            pending, state.pending = state.pending, None
+            state.scheduled = False
+        if pending is not None:
+            state.sink.show(*pending)
@@ -0,0 +1,116 @@
+'''Find scene cuts (shot boundaries) for jumping between shots
+
+One streaming pass over downscaled frames compares the color histogram
+of each frame with the one before it; a cut is a frame whose histogram
+changed by more than threshold. The cut list is saved next to the video
+like the frame index, so jumping to the previous/next cut is just a
+lookup plus one indexed seek.'''
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+
+import numpy as np
+
+from . import cv2_utils
+from .cache_utils import sidecar_filename, file_signature, replace_file
+
+SCENE_CUTS_VERSION = 1
+
+def color_histograms(frames, bits=3):
+    '''Normalized joint color histograms (N, 2**(3*bits)) of a batch of frames'''
+    n = len(frames)
+    shift = 8 - bits
+    q = (frames >> shift).astype(np.int64).reshape(n, -1, frames.shape[-1])
+    bins = (q[..., 0] << (2 * bits)) | (q[..., 1] << bits) | q[..., 2]
+    n_bins = 1 << (3 * bits)
+    offsets = (np.arange(n) * n_bins)[:, None]
+    counts = np.bincount((bins + offsets).ravel(), minlength=n * n_bins)
+    return counts.reshape(n, n_bins) / bins.shape[1]
+
+def histogram_distances(histograms, previous=None):
+    '''Half the L1 distance (0 to 1) between each histogram and the one before'''
+    first = histograms[:1] if previous is None else previous[None]
+    stack = np.concatenate([first, histograms])
+    return 0.5 * np.abs(np.diff(stack, axis=0)).sum(axis=1)
+
+def detect_scene_cuts(video_file, threshold=0.4, min_shot_length=5, downscale=4,
+                      batch_size=64, index=None, progress_callback=None):
+    '''Get the sorted frame numbers that start a new shot
+
+       Cuts closer than min_shot_length frames to the previous one are
+       ignored (flashes, fast pans). progress_callback(n_done), if given,
+       is called after each batch; returning True from it cancels the
+       pass (and None is returned).'''
+    cuts = []
+    with cv2_utils.VideoReader(video_file, index=index, downscale=downscale) as reader:
+        ret, frame = reader.read(0)
+        if not ret:
+            return np.zeros(0, dtype=np.int64)
+        batch = np.empty((batch_size,) + frame.shape, dtype=frame.dtype)
+        batch[0] = frame
+        n_batch, n_done = 1, 0
+        previous = None
+        last_cut = -min_shot_length
+        while True:
+            while n_batch < batch_size:
+                ret, _ = reader.read(out=batch[n_batch])
+                if not ret:
+                    break
+                n_batch += 1
+            histograms = color_histograms(batch[:n_batch])
+            distances = histogram_distances(histograms, previous)
+            for i in np.flatnonzero(distances > threshold):
+                frame_number = n_done + int(i)
+                if frame_number - last_cut >= min_shot_length:
+                    cuts.append(frame_number)
+                    last_cut = frame_number
+            previous = histograms[-1]
+            n_done += n_batch
+            if progress_callback is not None and progress_callback(n_done):
+                return None
+            if n_batch < batch_size:
+                break
+            n_batch = 0
+    return np.array(cuts, dtype=np.int64)
+
+def _params(threshold, min_shot_length):
+    return np.array([SCENE_CUTS_VERSION, threshold, min_shot_length], dtype=np.float64)
+
+def load_scene_cuts(cuts_file, signature, threshold, min_shot_length):
+    '''Load saved cuts, or return None if they are missing or stale'''
+    if not os.path.exists(cuts_file):
+        return None
+    try:
+        with np.load(cuts_file) as saved:
+            if (tuple(saved['signature']) != tuple(np.array(signature, dtype=np.float64)) or
+                tuple(saved['params']) != tuple(_params(threshold, min_shot_length))):
+                return None
+            return saved['cuts']
+    except (IOError, ValueError, KeyError):
+        return None
+
+def save_scene_cuts(cuts_file, cuts, signature, threshold, min_shot_length):
+    temp_filename = cuts_file + '.tmp'
+    with open(temp_filename, 'wb') as fid:
+        np.savez(fid, cuts=cuts, signature=np.array(signature, dtype=np.float64),
+                 params=_params(threshold, min_shot_length))
+    replace_file(temp_filename, cuts_file)
+
+def get_scene_cuts(video_file, rebuild=False, save=True, threshold=0.4,
+                   min_shot_length=5, **detect_options):
+    '''Load the sidecar cut list for a video, detecting (and saving) it if needed
+       (detect_options are passed on to detect_scene_cuts)'''
+    cuts_file = sidecar_filename(video_file, 'scene_cuts', '.npz')
+    signature = file_signature(video_file)
+    cuts = None if rebuild else load_scene_cuts(cuts_file, signature, threshold,
+                                                min_shot_length)
+    if cuts is None:
+        cuts = detect_scene_cuts(video_file, threshold, min_shot_length, **detect_options)
+        if cuts is not None and save:
+            try:
+                save_scene_cuts(cuts_file, cuts, signature, threshold, min_shot_length)
+            except (IOError, OSError):
+                pass
+    return cuts
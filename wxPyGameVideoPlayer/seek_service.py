@@ -0,0 +1,61 @@
+'''Decode seek targets in the background, newest request wins
+
+Scrubbing, clicking on the time plot or holding a step button can ask
+for frames much faster than they decode. Requests only replace a single
+pending slot, so whatever was asked for in the meantime is skipped and
+only the newest frame is decoded; a decode that finishes after a newer
+request came in is dropped instead of shown.'''
+
+from __future__ import absolute_import
+
+import threading
+
+class SeekService(threading.Thread):
+    '''Run load_function(request) for the latest request on a worker
+       thread and pass the result to on_ready(request, frame)
+       (called from the worker; frame may be None if it couldn't be read)
+       A request is whatever identifies the frame to the load function,
+       e.g. a (filename, frame_number) pair. close() ends the thread.'''
+    def __init__(self, load_function, on_ready):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.load_function = load_function
+        self.on_ready = on_ready
+        self.condition = threading.Condition()
+        self.pending = None
+        self.generation = 0 # bumped by every request and cancel
+        self.closed = False
+
+    def request(self, request):
+        '''Ask for a frame, replacing any request that hasn't started yet'''
+        with self.condition:
+            self.pending = request
+            self.generation += 1
+            self.condition.notify()
+
+    def cancel(self):
+        '''Forget the pending request and drop the one being decoded'''
+        with self.condition:
+            self.pending = None
+            self.generation += 1
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pending = None
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                request, generation = self.pending, self.generation
+                self.pending = None
+            frame = self.load_function(request)
+            with self.condition:
+                if generation != self.generation: # superseded while decoding
+                    continue
+            self.on_ready(request, frame)
@@ -1,14 +1,49 @@
 import os
-import skimage
+import subprocess
+import multiprocessing
 
 import numpy as np
+import cv2
 
-from np_utils import makeifnotexists
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, parallel mode falls back to one process
+    shared_memory = None
 
 from . import cv2_utils
+from . import frame_cache
+from . import frame_index
 
-if os.system("ffmpeg -h") != 0:
-    print("Warning: ffmpeg not found on system, fast thumbnail functions will work")
+# Worker pools are started with "spawn" (as in proxy.py): forking the GUI
+# process while its threads hold locks can deadlock the workers
+_mp = (
+    multiprocessing.get_context("spawn")
+    if hasattr(multiprocessing, "get_context")
+    else multiprocessing
+)  # Python 2 can only fork
+
+_FFMPEG_AVAILABLE = None
+
+
+def ffmpeg_available():
+    """Check (once per process) whether ffmpeg can be run"""
+    global _FFMPEG_AVAILABLE
+    if _FFMPEG_AVAILABLE is None:
+        try:
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call(
+                    ["ffmpeg", "-version"], stdout=devnull, stderr=devnull
+                )
+            _FFMPEG_AVAILABLE = True
+        except (OSError, subprocess.CalledProcessError):
+            _FFMPEG_AVAILABLE = False
+    return _FFMPEG_AVAILABLE
+
+
+def _makeifnotexists(directory):
+    from np_utils import makeifnotexists
+
+    return makeifnotexists(directory)
 
 
 def thumbnail(im, max_shape):
@@ -18,9 +53,11 @@ def thumbnail(im, max_shape):
     Use create_thumbnails_video_using_ffmpeg and
     thumbstrip_from_video_frames instead
     """
+    from skimage.transform import resize  # slow to import, so only when needed
+
     scale = max_shape / max(im.shape[:2])
     new_shape = [int(scale * i) for i in im.shape[:2]]
-    return skimage.transform.resize(im, new_shape)
+    return resize(im, new_shape)
 
 
 def create_thumbnails_video_using_ffmpeg(filename, output_dir, max_shape):
@@ -32,8 +69,14 @@ def create_thumbnails_video_using_ffmpeg(filename, output_dir, max_shape):
     
     Using ffmpeg is both faster and yeilds higher compression ratios
     than using OpenCV and saving frames using numpy.
+
+    See proxy.create_proxy for an in-process alternative that doesn't
+    need ffmpeg installed (and proxy.ProxyBuilder to run it in the background)
     """
-    makeifnotexists(output_dir)
+    if not ffmpeg_available():
+        raise Exception("ffmpeg not found on system, use proxy.create_proxy instead")
+
+    _makeifnotexists(output_dir)
 
     max_w, max_h = (
         max_shape if hasattr(max_shape, "__len__") else (max_shape, max_shape)
@@ -43,11 +86,9 @@ def create_thumbnails_video_using_ffmpeg(filename, output_dir, max_shape):
     add = "_fit_to_{}_{}".format(max_w, max_h)
     output_filename = os.path.join(output_dir, fn + add + ext)
 
-    cmd_template = (
-        'ffmpeg -i "{}" -vf "scale={}:{}:force_original_aspect_ratio=decrease" "{}"'
-    )
-    cmd = cmd_template.format(filename, max_w, max_h, output_filename)
-    if os.system(cmd) != 0:
+    scale = "scale={}:{}:force_original_aspect_ratio=decrease".format(max_w, max_h)
+    cmd = ["ffmpeg", "-i", filename, "-vf", scale, output_filename]
+    if subprocess.call(cmd) != 0:
         raise Exception("ffmpeg command failed creating file for {}".format(filename))
 
     return output_filename
@@ -64,38 +105,174 @@ def thumbstrip(arr, orientation="horizontal"):
     return arr_strip if orientation == "vertical" else arr_strip.swapaxes(0, 1)
 
 
-def thumbstrip_from_video_frames(filename, frame_numbers, orientation="horizontal"):
-    """Create a thumbstrip by loading spcified frames from a video file
+def _keyframe_segments(unique_frame_numbers, index, n_segments):
+    """Split sorted, unique frame numbers into about n_segments runs
+    that never split a GOP, so no two workers decode the same GOP
     """
-    frame_rate = cv2_utils.get_frame_rate(filename)
-    frames_arr = np.array(
-        [
-            cv2_utils.get_opencv_frame(filename, frame_number, frame_rate=frame_rate)[1]
-            for frame_number in frame_numbers
+    keyframes = index.keyframes[
+        np.searchsorted(index.keyframes, unique_frame_numbers, side="right") - 1
+    ]
+    groups = np.split(unique_frame_numbers, np.flatnonzero(np.diff(keyframes)) + 1)
+    n_segments = max(min(n_segments, len(groups)), 1)
+    bounds = np.linspace(0, len(groups), n_segments + 1).astype(int)
+    return [np.concatenate(groups[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _decode_segment(args):
+    """Worker: decode a segment's frames into the shared output array"""
+    filename, shm_name, shape, dtype, frame_numbers, positions = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        out_flat = out.reshape((-1,) + shape[-3:])
+        index = frame_index.get_frame_index(filename)
+        with cv2_utils.VideoReader(filename, index=index) as reader:
+            for frame_number, pos in zip(frame_numbers, positions):
+                first = pos[0]
+                if not reader.read(frame_number, out=out_flat[first])[0]:
+                    out_flat[first] = 0
+                out_flat[pos[1:]] = out_flat[first]
+        del out, out_flat  # release the buffer before closing
+    finally:
+        shm.close()
+
+
+def map_frames_parallel(filename, frame_numbers, func, n_workers=None):
+    """Decode frames with a pool of processes and call func on the result
+
+    Frames are split into keyframe-aligned segments, each worker opens its
+    own capture and writes its frames straight into a shared memory
+    array (in the layout of frame_numbers), and func (e.g. image_grid)
+    is called on a view of that array, so there are no copies beyond
+    what func itself makes. Returns func's result
+    """
+    frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+    n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+    if shared_memory is None or n_workers <= 1:
+        return func(cv2_utils.get_frames(filename, frame_numbers))
+
+    index = frame_index.get_frame_index(filename)
+    with cv2_utils.VideoReader(filename) as reader:
+        width = int(reader.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(reader.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    shape = frame_numbers.shape + (height, width, 3)
+    dtype = np.dtype(np.uint8)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)), 1))
+    try:
+        # Where each unique frame goes in the (flattened) output
+        order = np.argsort(frame_numbers.ravel(), kind="mergesort")
+        sorted_numbers = frame_numbers.ravel()[order]
+        splits = np.flatnonzero(np.diff(sorted_numbers)) + 1
+        unique = sorted_numbers[np.concatenate([[0], splits])]
+        positions = dict(zip(unique, np.split(order, splits)))
+        jobs = [
+            (filename, shm.name, shape, dtype, segment, [positions[n] for n in segment])
+            for segment in _keyframe_segments(unique, index, 4 * n_workers)
         ]
-    )
+        pool = _mp.Pool(min(n_workers, len(jobs)))
+        try:
+            pool.map(_decode_segment, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        frames_arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = func(frames_arr)
+        if isinstance(result, np.ndarray) and np.shares_memory(result, frames_arr):
+            result = result.copy()  # the shared memory is about to go away
+        del frames_arr
+        return result
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def thumbstrip_from_video_frames(
+    filename, frame_numbers, orientation="horizontal", cache=None, n_workers=None
+):
+    """Create a thumbstrip by loading spcified frames from a video file
+    (frames already in the frame cache are not decoded again)
+
+    With n_workers > 1, frames are decoded by a pool of processes instead
+    (see map_frames_parallel)
+    """
+    if n_workers is not None and n_workers > 1:
+        return map_frames_parallel(
+            filename,
+            frame_numbers,
+            lambda frames_arr: thumbstrip(frames_arr, orientation=orientation),
+            n_workers=n_workers,
+        )
+    cache = frame_cache.default_cache if cache is None else cache
+    frames_arr = cv2_utils.get_frames(filename, frame_numbers, cache=cache)
     return thumbstrip(frames_arr, orientation=orientation)
 
 
 def image_grid(images_2d_grid):
-    a = np.array(images_2d_grid)
+    a = np.asarray(images_2d_grid)
     new_shape = (a.shape[0] * a.shape[2], a.shape[1] * a.shape[3]) + a.shape[4:]
     return a.swapaxes(1, 2).reshape(new_shape)
 
 
-def thumb_grid_from_video_frames(filename, frame_numbers_grid):
+def thumb_grid_from_video_frames(
+    filename, frame_numbers_grid, cache=None, n_workers=None
+):
     """Create a thumbstrip grid by loading specified frames from a video file
+    (frames already in the frame cache are not decoded again)
+
+    With n_workers > 1, frames are decoded by a pool of processes instead
+    (see map_frames_parallel)
     """
-    frame_rate = cv2_utils.get_frame_rate(filename)
-    frames_arr = np.array(
-        [
-            [
-                cv2_utils.get_opencv_frame(
-                    filename, frame_number, frame_rate=frame_rate
-                )[1]
-                for frame_number in frame_numbers
-            ]
-            for frame_numbers in frame_numbers_grid
-        ]
-    )
+    if n_workers is not None and n_workers > 1:
+        return map_frames_parallel(
+            filename, frame_numbers_grid, image_grid, n_workers=n_workers
+        )
+    cache = frame_cache.default_cache if cache is None else cache
+    frames_arr = cv2_utils.get_frames(filename, frame_numbers_grid, cache=cache)
     return image_grid(frames_arr)
+
+
+def evenly_spaced_frame_grid(num_frames, grid_shape):
+    """Frame numbers spread evenly over a video, in a grid_shape grid"""
+    n = int(np.prod(grid_shape))
+    return np.linspace(0, num_frames - 1, n).astype(np.int64).reshape(grid_shape)
+
+
+def _contact_sheet_job(args):
+    filename, output_filename, grid_shape = args
+    index = frame_index.get_frame_index(filename)
+    grid = evenly_spaced_frame_grid(len(index), grid_shape)
+    with cv2_utils.VideoReader(filename, index=index) as reader:
+        sheet = image_grid(cv2_utils.get_frames(reader, grid))
+    if not cv2.imwrite(output_filename, sheet):
+        raise IOError("Could not write {}".format(output_filename))
+    return output_filename
+
+
+def contact_sheets_for_files(
+    filenames, output_dir, grid_shape=(10, 10), n_workers=None, ext=".jpg"
+):
+    """Write a contact sheet (a grid of evenly spaced frames) for every file
+
+    For batch runs over many recordings, each worker process handles
+    whole files, which keeps every worker busy without any sharing
+    (use thumb_grid_from_video_frames with n_workers for one big file)
+    Returns the list of output filenames
+    """
+    _makeifnotexists(output_dir)
+    jobs = [
+        (
+            filename,
+            os.path.join(output_dir, os.path.basename(filename) + "_contact_sheet" + ext),
+            grid_shape,
+        )
+        for filename in filenames
+    ]
+    n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+    if n_workers <= 1:
+        return [_contact_sheet_job(job) for job in jobs]
+    pool = _mp.Pool(n_workers)
+    try:
+        return pool.map(_contact_sheet_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import wx
+from bisect import bisect_left, bisect_right
 from functools import partial
 
 from .wx_func_utils import (static_text, text_ctrl, check_box, button, static_box,
@@ -22,6 +23,8 @@ class DummyDataInterface(object):
         pass
     def get_number_of_frames(self):
         return 50
+    def get_scene_cuts(self, on_ready=None):
+        return []
 
 SKIP_VALUE = 20
 
@@ -33,6 +36,9 @@ class PlaybackControlsFrameMixin(wx.Frame):
        Functions:
            update_data(self)
            get_last_frame(self)
+           get_scene_cuts(self, on_ready) (sorted frame numbers, or None while
+                                           they are being found; on_ready()
+                                           is called once they are)
            play(self, reverse=False)
            stop(self)
     '''
@@ -57,6 +63,9 @@ class PlaybackControlsFrameMixin(wx.Frame):
         self.rewind_button = button(self, '<|', min_size=(35, -1),
                                     tooltip='Rewind',
                                     callback=partial(self.play, reverse=True))
+        self.previous_cut_button = button(self, '<<', min_size=(35, -1),
+                                          tooltip='Jump to the previous scene cut',
+                                          callback=partial(self.jump_to_cut, -1))
         self.jump_back_button = button(self, '-'+str(SKIP_VALUE), min_size=(15*(len(str(SKIP_VALUE))+1), -1),
                                        tooltip='Jump back {0} frames'.format(SKIP_VALUE),
                                        callback=partial(self.offset_frame_num, -SKIP_VALUE), )
@@ -72,6 +81,9 @@ class PlaybackControlsFrameMixin(wx.Frame):
         self.jump_forward_button = button(self, '+'+str(SKIP_VALUE), min_size=(15*(len(str(SKIP_VALUE))+1), -1),
                                           tooltip='Jump forward {0} frames'.format(SKIP_VALUE),
                                           callback=partial(self.offset_frame_num, 10))
+        self.next_cut_button = button(self, '>>', min_size=(35, -1),
+                                      tooltip='Jump to the next scene cut',
+                                      callback=partial(self.jump_to_cut, 1))
         self.play_button = button(self, '|>', min_size=(35, -1),
                                   tooltip='Go back one frame',
                                   callback=partial(self.play, reverse=False))
@@ -90,11 +102,13 @@ class PlaybackControlsFrameMixin(wx.Frame):
                                                (45, 20),
                                                self.skip_to_start_button,
                                                self.rewind_button,
+                                               self.previous_cut_button,
                                                self.jump_back_button,
                                                self.step_back_button,
                                                self.stop_button,
                                                self.step_forward_button,
                                                self.jump_forward_button,
+                                               self.next_cut_button,
                                                self.play_button,
                                                self.skip_to_end_button
                                               )
@@ -124,6 +138,9 @@ class PlaybackControlsFrameMixin(wx.Frame):
     def get_playback_speed(self):
         return int(self.playback_speed_textbox.GetValue())
     
+    def get_skip_frames(self):
+        return bool(self.skip_frames_checkbox.GetValue())
+    
     def set_playback_speed(self, speed):
         self.playback_speed_textbox.SetValue(str(speed))
 
@@ -133,6 +150,20 @@ class PlaybackControlsFrameMixin(wx.Frame):
 
     def skip_to_end(self): # Because you can only cheat so much :)
         return self.set_frame_number(self.get_last_frame())
+    
+    def jump_to_cut(self, direction):
+        '''Go to the next (direction=1) or previous (direction=-1) scene cut
+           If the cuts are still being found, this jumps once they are'''
+        cuts = self.get_scene_cuts(partial(self.jump_to_cut, direction))
+        if cuts is None:
+            return
+        frame_number = self.get_frame_number()
+        if direction > 0:
+            i = bisect_right(cuts, frame_number)
+        else:
+            i = bisect_left(cuts, frame_number) - 1
+        if 0 <= i < len(cuts):
+            self.set_frame_number(cuts[i])
 
 class VideoPlayerFrame(PlaybackControlsFrameMixin):
     def __init__(self, *args, **kwds):
@@ -196,6 +227,10 @@ class VideoPlayerFrame(PlaybackControlsFrameMixin):
         self.trace_checkbox_sizer = AddMultiple(VSizer(), (0, 0, 0),
                                                 *self.trace_checkboxes)
 
+    def get_checked_traces(self):
+        return [name for name, checkbox in zip(self.traces_checkbox_names, self.trace_checkboxes)
+                if checkbox.GetValue()]
+    
     def set_data(self, data_object):
         self.data = data_object
     
@@ -205,10 +240,13 @@ class VideoPlayerFrame(PlaybackControlsFrameMixin):
     def get_last_frame(self):
         return self.data.get_number_of_frames() - 1
     
+    def get_scene_cuts(self, on_ready=None):
+        return self.data.get_scene_cuts(on_ready)
+    
     def play(self, reverse=False):
         start_frame = self.get_frame_number()
         playback_speed = self.get_playback_speed()
-        skip_frames = bool(self.skip_frames_checkbox.GetValue())
+        skip_frames = self.get_skip_frames()
         self.data.play(start_frame, playback_speed=playback_speed, reverse=reverse, skip_frames=skip_frames)
     
     def stop(self):